@@ -0,0 +1,150 @@
+# ann_index.py — NumPy inverted-file (IVF) index for large embedding galleries
+#
+# A spherical k-means coarse quantiser splits the gallery into `nlist` cells.
+# A query is scored against the centroids first and only the rows of the
+# `nprobe` closest cells are scored exactly, so cost per face drops from
+# O(rows) to roughly O(nlist + rows * nprobe / nlist).
+#
+# The index persists only centroids and each student's cell assignments;
+# the vectors themselves stay in the gallery, so there is a single copy.
+from pathlib import Path
+
+import numpy as np
+
+from gallery import l2_normalize
+
+DEFAULT_NPROBE = 8
+
+
+def default_nlist(rows):
+    """Roughly sqrt(rows) cells, the usual IVF sizing rule."""
+    return int(max(16, min(4096, 4 * np.sqrt(max(rows, 1)))))
+
+
+def _nearest(vectors, centroids, chunk=8192):
+    out = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], chunk):
+        block = vectors[start:start + chunk]
+        out[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex:
+    """Coarse quantiser plus per-student cell assignments."""
+
+    def __init__(self, centroids, trained_rows=0, assignments=None):
+        self.centroids    = l2_normalize(centroids)
+        self.trained_rows = int(trained_rows)
+        self.assignments  = dict(assignments or {})
+        self.dirty        = False   # assignments changed since the last save/load
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(cls, matrix, nlist=None, iters=10, sample=None, seed=0):
+        """Fit centroids with spherical k-means on (a sample of) `matrix`."""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        rows   = matrix.shape[0]
+        nlist  = min(nlist or default_nlist(rows), rows)
+        rng    = np.random.default_rng(seed)
+        sample = sample or nlist * 64
+        if matrix.shape[0] > sample:
+            matrix = matrix[rng.choice(matrix.shape[0], sample, replace=False)]
+        centroids = matrix[rng.choice(matrix.shape[0], nlist, replace=False)].copy()
+        for _ in range(iters):
+            labels = _nearest(matrix, centroids)
+            sums   = np.zeros_like(centroids)
+            np.add.at(sums, labels, matrix)
+            empty  = ~sums.any(axis=1)
+            # Re-seed empty cells from random rows so no cell is wasted
+            sums[empty] = matrix[rng.choice(matrix.shape[0], int(empty.sum()))]
+            centroids = l2_normalize(sums)
+        return cls(centroids, trained_rows=rows)
+
+    def assign(self, vectors):
+        """Cell id of every (normalised) row in `vectors`."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[0] == 0:
+            return np.zeros(0, dtype=np.int32)
+        return _nearest(vectors, self.centroids)
+
+    def update_student(self, student_id, vectors):
+        self.assignments[str(student_id)] = self.assign(l2_normalize(vectors))
+        self.dirty = True
+
+    def remove_student(self, student_id):
+        if self.assignments.pop(str(student_id), None) is not None:
+            self.dirty = True
+
+    def assignments_for(self, student_id, vectors):
+        """Stored assignments for a student, recomputed if the row count changed."""
+        cached = self.assignments.get(str(student_id))
+        if cached is None or cached.shape[0] != vectors.shape[0]:
+            cached = self.assign(vectors)
+            self.assignments[str(student_id)] = cached
+            self.dirty = True
+        return cached
+
+    # ── Persistence ───────────────────────────────────────────────────────────
+
+    def save(self, path):
+        path        = Path(path)
+        student_ids = list(self.assignments)
+        counts      = [self.assignments[s].shape[0] for s in student_ids]
+        flat        = (np.concatenate([self.assignments[s] for s in student_ids])
+                       if student_ids else np.zeros(0, dtype=np.int32))
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, centroids=self.centroids, trained_rows=self.trained_rows,
+                     student_ids=np.array(student_ids, dtype=str),
+                     counts=np.array(counts, dtype=np.int64), assign=flat.astype(np.int32))
+        tmp.replace(path)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        with np.load(str(path)) as data:
+            offsets = np.concatenate(([0], np.cumsum(data["counts"])))
+            flat    = data["assign"]
+            assignments = {sid: flat[offsets[i]:offsets[i + 1]].copy()
+                           for i, sid in enumerate(data["student_ids"].tolist())}
+            return cls(data["centroids"], int(data["trained_rows"]), assignments)
+
+
+class IVFSearcher:
+    """Inverted lists over one gallery snapshot's rows."""
+
+    def __init__(self, index, row_cells, matrix, owners):
+        self.index  = index
+        self.matrix = matrix
+        self.owners = owners
+        self._order = np.argsort(row_cells, kind="stable")
+        # rows in cell `nlist` (unused gallery rows) fall past the last bound
+        bounds      = np.searchsorted(row_cells[self._order], np.arange(index.nlist + 1))
+        self._start = bounds[:-1]
+        self._end   = bounds[1:]
+
+    def search(self, queries, k, nprobe=DEFAULT_NPROBE):
+        """Per query, the best `k` distinct owners as ``(owner_positions, scores)``."""
+        nprobe = max(1, min(nprobe, self.index.nlist))
+        coarse = queries @ self.index.centroids.T
+        if nprobe < self.index.nlist:
+            probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.tile(np.arange(self.index.nlist), (queries.shape[0], 1))
+
+        results = []
+        for query, cells in zip(queries, probes):
+            rows = np.concatenate([self._order[self._start[c]:self._end[c]] for c in cells])
+            if rows.size == 0:
+                results.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)))
+                continue
+            scores = self.matrix[rows] @ query
+            ranked = np.argsort(-scores)
+            # first occurrence of each owner in score order == its best template
+            _, first = np.unique(self.owners[rows[ranked]], return_index=True)
+            best     = ranked[np.sort(first)[:k]]
+            results.append((self.owners[rows[best]], scores[best]))
+        return results
@@ -10,13 +10,18 @@ import json
 import base64
 import logging
 import threading
+import time
+import uuid
 from datetime import datetime, timedelta
 from pathlib import Path
 from functools import wraps
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 from bson import ObjectId
 from bson.errors import InvalidId
+from pymongo import ReturnDocument
 
 # Optional imports with fallbacks
 try:
@@ -35,7 +40,7 @@ except ImportError:
 
 import numpy as np
 import cv2
-from PIL import Image, ImageOps
+from PIL import Image
 from flask import (
     Flask, render_template, request, redirect, url_for,
     flash, jsonify, Response, session, send_from_directory
@@ -44,6 +49,18 @@ from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from db import get_db, init_indexes, ping as db_ping
+from gallery import Gallery, EMPTY_GALLERY, QUANTIZATION_MODES
+from ann_index import IVFIndex
+from embedding_store import EmbeddingStore, FileLock, FCNTL_AVAILABLE
+from shared_gallery import SharedGalleryChannel, encode_snapshot
+from inference_pool import InferencePool, PoolBusy
+from detection import detect_tiled
+from imaging import load_image_rgb
+import encoding_pipeline
+import attendance_stats
+import attendance_writer
+from face_embedding import embed_crops, face_crop, faces_from_detections
+from tracking import IoUTracker
 
 # ==================== CONFIGURATION ====================
 BASE_DIR      = Path(__file__).parent.absolute()
@@ -52,37 +69,130 @@ ENCODINGS_DIR = BASE_DIR / "encodings"
 UPLOADS_DIR   = BASE_DIR / "uploads"
 FACES_DIR     = UPLOADS_DIR / "faces"
 THUMB_DIR     = UPLOADS_DIR / "thumbs"
+RESULTS_DIR   = UPLOADS_DIR / "results"
 LOGS_DIR      = BASE_DIR / "logs"
 
-for _d in [DATASET_DIR, ENCODINGS_DIR, UPLOADS_DIR, FACES_DIR, THUMB_DIR, LOGS_DIR]:
+for _d in [DATASET_DIR, ENCODINGS_DIR, UPLOADS_DIR, FACES_DIR, THUMB_DIR, RESULTS_DIR, LOGS_DIR]:
     _d.mkdir(parents=True, exist_ok=True)
 
-INDEX_FILE    = ENCODINGS_DIR / "index.json"
+INDEX_FILE    = ENCODINGS_DIR / "index.json"   # legacy layout, migrated into the store on first use
+ANN_INDEX_FILE = ENCODINGS_DIR / "ann_index.npz"
 TIMELINE_FILE = LOGS_DIR / "timeline.json"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "PNG", "JPG", "JPEG"}
 
 RECOGNITION_THRESHOLD = float(os.environ.get("RECOGNITION_THRESHOLD", 0.5))
+RECOGNITION_TOP_K     = int(os.environ.get("RECOGNITION_TOP_K", 3))
+GALLERY_MODE          = os.environ.get("GALLERY_MODE", "templates")
+GALLERY_QUANTIZATION  = os.environ.get("GALLERY_QUANTIZATION", "none")   # none | int8
+if GALLERY_QUANTIZATION not in QUANTIZATION_MODES:
+    print(f"⚠️ GALLERY_QUANTIZATION={GALLERY_QUANTIZATION} is not supported; using none")
+    GALLERY_QUANTIZATION = "none"
+RESCORE_CANDIDATES    = int(os.environ.get("RESCORE_CANDIDATES", 10))
+ANN_INDEX             = os.environ.get("ANN_INDEX", "auto")   # auto | ivf | off
+ANN_MIN_ROWS          = int(os.environ.get("ANN_MIN_ROWS", 50000))
+ANN_NPROBE            = int(os.environ.get("ANN_NPROBE", 8))
+SHARED_GALLERY        = os.environ.get("SHARED_GALLERY", "false").lower() == "true"
+SHARED_GALLERY_NAME   = os.environ.get("SHARED_GALLERY_NAME", "attendance_gallery")
+INSIGHTFACE_MODEL     = os.environ.get("INSIGHTFACE_MODEL", "buffalo_l")
+INSIGHTFACE_PROFILE   = os.environ.get("INSIGHTFACE_PROFILE", "recognition")   # recognition | landmarks | full
+INSIGHTFACE_DET_SIZE  = int(os.environ.get("INSIGHTFACE_DET_SIZE", 640))
+USE_CUDA              = os.environ.get("USE_CUDA", "false").lower() == "true"
+INFERENCE_WORKERS     = max(1, int(os.environ.get("INFERENCE_WORKERS", 2)))
+INFERENCE_THREADS     = int(os.environ.get("INFERENCE_THREADS", 0)) or max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS)
+INFERENCE_QUEUE       = int(os.environ.get("INFERENCE_QUEUE", 8))
+JOB_WORKERS           = int(os.environ.get("JOB_WORKERS", INFERENCE_WORKERS))
+JOB_QUEUE             = int(os.environ.get("JOB_QUEUE", 100))
+ENCODING_PROCESSES    = int(os.environ.get("ENCODING_PROCESSES", os.cpu_count() or 1))
+ENCODING_BATCH        = int(os.environ.get("ENCODING_BATCH", 8))   # student folders per worker task
+ENCODING_MAX_SIDE     = int(os.environ.get("ENCODING_MAX_SIDE", 2 * INSIGHTFACE_DET_SIZE))
+# Embeddings recorded under another model or decode size are recomputed
+ENCODING_MODEL_ID     = f"{INSIGHTFACE_MODEL}@{ENCODING_MAX_SIDE}"
+EMBED_BATCH_SIZE      = int(os.environ.get("EMBED_BATCH_SIZE", 32))   # face crops per recognition-model call
+RECOGNIZE_BATCH_MAX   = int(os.environ.get("RECOGNIZE_BATCH_MAX", 6))
+STREAM_IDLE_SECONDS   = int(os.environ.get("STREAM_IDLE_SECONDS", 300))
+CSV_FLUSH_ROWS        = 500   # rows per chunk of a streamed CSV export
+RECONCILE_SECONDS     = int(os.environ.get("RECONCILE_SECONDS", 3600))   # student counter recount; 0 = on demand only
+TILED_DETECTION       = os.environ.get("TILED_DETECTION", "auto")   # auto | on | off
+TILE_MIN_SIDE         = int(os.environ.get("TILE_MIN_SIDE", 2000))
+TILE_SIZE             = int(os.environ.get("TILE_SIZE", 2 * INSIGHTFACE_DET_SIZE))
+TILE_OVERLAP          = float(os.environ.get("TILE_OVERLAP", 0.25))
+# Longest side photos are decoded at for recognition; 0 = full resolution. Tiles want
+# native pixels, while the plain detector never looks at more than det_size, so with
+# "auto" only photos whose header size means they will be tiled skip the reduced decode.
+DECODE_MAX_SIDE       = int(os.environ.get("DECODE_MAX_SIDE",
+                                           0 if TILED_DETECTION == "on" else 2 * INSIGHTFACE_DET_SIZE))
+DECODE_FULL_FROM      = TILE_MIN_SIDE if TILED_DETECTION == "auto" else 0
 
 # ==================== INSIGHTFACE ====================
 try:
     from insightface.app import FaceAnalysis
-    from insightface.model_zoo import get_model
     INSIGHTFACE_AVAILABLE = True
 except ImportError:
     INSIGHTFACE_AVAILABLE = False
 
-insightface_app = None
-face_model      = None
+# Model-pack modules to load; the pack's gender/age and 3D landmark heads are
+# never used, and each costs an ONNX session and its memory
+INSIGHTFACE_PROFILES = {
+    "recognition": ["detection", "recognition"],
+    "landmarks":   ["detection", "recognition", "landmark_2d_106"],
+    "full":        None,
+}
+
+insightface_app   = None
+face_model        = None   # the pack's recognition model, shared with insightface_app
+insightface_stats = {}
+inference_pool    = None   # INFERENCE_WORKERS replicas; insightface_app is the first
+
+
+def _load_face_analysis(providers):
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = INFERENCE_THREADS
+    options.inter_op_num_threads = 1
+    analyzer = FaceAnalysis(name=INSIGHTFACE_MODEL, providers=providers, sess_options=options,
+                            allowed_modules=INSIGHTFACE_PROFILES.get(INSIGHTFACE_PROFILE,
+                                                                     INSIGHTFACE_PROFILES["recognition"]))
+    analyzer.prepare(ctx_id=0 if USE_CUDA else -1,
+                     det_size=(INSIGHTFACE_DET_SIZE, INSIGHTFACE_DET_SIZE))
+    return analyzer
+
+
+def _warm_up(analyzer):
+    # ONNX Runtime allocates and optimises lazily on the first run; pay for it at boot
+    analyzer.get(np.zeros((INSIGHTFACE_DET_SIZE, INSIGHTFACE_DET_SIZE, 3), dtype=np.uint8))
+    analyzer.models["recognition"].get_feat(np.zeros((112, 112, 3), dtype=np.uint8))
+
 
 def init_insightface():
-    global insightface_app, face_model
+    """Load one model replica per inference worker and warm each of them up."""
+    global insightface_app, face_model, insightface_stats, inference_pool
     if not INSIGHTFACE_AVAILABLE:
         return False
     try:
-        insightface_app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
-        insightface_app.prepare(ctx_id=0, det_size=(640, 640))
-        face_model = get_model("buffalo_l", download=True)
-        face_model.prepare(ctx_id=0)
+        providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if USE_CUDA else ["CPUExecutionProvider"]
+        started   = time.perf_counter()
+        replicas  = [_load_face_analysis(providers) for _ in range(INFERENCE_WORKERS)]
+        loaded    = time.perf_counter()
+        for replica in replicas:
+            _warm_up(replica)
+        warmed = time.perf_counter()
+
+        insightface_app = replicas[0]
+        face_model      = insightface_app.models["recognition"]
+        inference_pool  = InferencePool(replicas, INFERENCE_QUEUE)
+        insightface_stats = {
+            "model":            INSIGHTFACE_MODEL,
+            "profile":          INSIGHTFACE_PROFILE,
+            "modules":          sorted(insightface_app.models),
+            "providers":        providers,
+            "workers":          INFERENCE_WORKERS,
+            "intra_op_threads": INFERENCE_THREADS,
+            "load_ms":          round((loaded - started) * 1000, 1),
+            "warmup_ms":        round((warmed - loaded) * 1000, 1),
+        }
+        print(f"✅ InsightFace {INSIGHTFACE_MODEL} [{', '.join(insightface_stats['modules'])}] "
+              f"× {INFERENCE_WORKERS} workers ({INFERENCE_THREADS} threads each) "
+              f"loaded in {insightface_stats['load_ms']:.0f} ms, warm-up {insightface_stats['warmup_ms']:.0f} ms")
         return True
     except Exception as e:
         print(f"❌ InsightFace init failed: {e}")
@@ -116,13 +226,33 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in {e.lower() for e in ALLOWED_EXTENSIONS}
 
 
+def _replace_atomically(path, write):
+    """Call ``write(tmp_path)`` on a per-call temp file, then move it onto `path`.
+
+    Concurrent writers of the same file each use their own temp name, so
+    readers only ever see a complete file; a target another writer already
+    published counts as success.
+    """
+    tmp = path.with_name(f"{path.stem}.{uuid.uuid4().hex}.tmp{path.suffix}")
+    try:
+        write(tmp)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            if not path.exists():
+                raise
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return path
+
+
 def save_thumbnail(image_path, max_size=320):
     try:
         img = Image.open(str(image_path)).convert("RGB")
         img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
         thumb_name = f"thumb_{image_path.name}"
-        thumb_path = THUMB_DIR / thumb_name
-        img.save(str(thumb_path), "JPEG", quality=85)
+        _replace_atomically(THUMB_DIR / thumb_name, lambda tmp: img.save(str(tmp), "JPEG", quality=85))
         return f"uploads/thumbs/{thumb_name}"
     except Exception:
         return None
@@ -167,215 +297,602 @@ def append_to_timeline(photo_name, marked_count, total_faces, subject="", teache
         print(f"Timeline error: {e}")
 
 # ==================== EMBEDDINGS CACHE ====================
-_embeddings_cache      = None
-_embeddings_cache_lock = threading.Lock()
+# The cache holds an immutable Gallery snapshot. Readers take whatever snapshot
+# is published without locking; writers derive a new snapshot from a delta
+# (upsert / remove / rename) under the lock and publish it with one assignment.
+#
+# With SHARED_GALLERY on, snapshots are also published to the other worker
+# processes: each delta is applied under a cross-process lock and its table is
+# written to shared memory with a new generation number. A worker whose local
+# generation is behind adopts the latest table, wrapping the same memory-mapped
+# store file, so every process sees enrolments without re-reading the store.
+_embeddings_cache            = None
+_embeddings_cache_file       = None   # store data file the snapshot's offsets refer to
+_embeddings_cache_generation = 0      # shared generation the snapshot was adopted from
+_embeddings_cache_lock       = threading.Lock()
+
+embedding_store = EmbeddingStore(ENCODINGS_DIR, legacy_index=INDEX_FILE)
+shared_gallery  = (SharedGalleryChannel(SHARED_GALLERY_NAME, ENCODINGS_DIR / ".gallery.lock")
+                   if SHARED_GALLERY else None)
+
+
+def _new_gallery(student_ids, names, counts, offsets, matrix):
+    gallery = Gallery(student_ids, names, counts, matrix,
+                      mode=GALLERY_MODE,
+                      offsets=offsets,
+                      normalized=True,
+                      quantization=GALLERY_QUANTIZATION,
+                      rescore=RESCORE_CANDIDATES)
+    attach_ann_index(gallery)
+    return gallery
+
+
+def _build_gallery():
+    students = embedding_store.students()
+    return _new_gallery(list(students),
+                        [e["name"] for e in students.values()],
+                        [e["count"] for e in students.values()],
+                        [e["offset"] for e in students.values()],
+                        embedding_store.matrix)
+
+
+def _publish_shared(gallery):
+    """Hand a snapshot to the other workers. Call under ``shared_gallery.lock()``."""
+    global _embeddings_cache_generation
+    payload = encode_snapshot(gallery.student_ids, gallery.names, gallery.src_offsets,
+                              gallery.src_counts, _embeddings_cache_file, gallery.source.shape[0])
+    _embeddings_cache_generation = shared_gallery.publish(payload)
+
+
+def _sync_shared_gallery(force_reload=False):
+    """Adopt the latest shared snapshot, or build and publish one if there is none."""
+    global _embeddings_cache, _embeddings_cache_file, _embeddings_cache_generation
+    latest = None if force_reload else shared_gallery.read()
+    if latest is not None:
+        generation, snapshot = latest
+        if generation == _embeddings_cache_generation and _embeddings_cache is not None:
+            return
+        try:
+            gallery = _new_gallery(snapshot["student_ids"], snapshot["names"], snapshot["counts"],
+                                   snapshot["offsets"],
+                                   embedding_store.mapped(snapshot["data_file"], snapshot["rows"]))
+            _embeddings_cache_file       = snapshot["data_file"]
+            _embeddings_cache_generation = generation
+            _embeddings_cache            = gallery
+            return
+        except FileNotFoundError:
+            pass  # its data file was compacted away; rebuild from the store below
+    with shared_gallery.lock():
+        _embeddings_cache_file = embedding_store.data_file
+        _embeddings_cache      = _build_gallery()
+        _publish_shared(_embeddings_cache)
 
 
 def load_all_embeddings(force_reload=False):
-    global _embeddings_cache
+    """Return the published Gallery, wrapping the memory-mapped store on first use."""
+    global _embeddings_cache, _embeddings_cache_file
+    gallery = _embeddings_cache
+    if gallery is not None and not force_reload and (
+            shared_gallery is None or shared_gallery.generation() == _embeddings_cache_generation):
+        return gallery
     with _embeddings_cache_lock:
-        if _embeddings_cache is not None and not force_reload:
-            return _embeddings_cache
-        if not INDEX_FILE.exists():
-            _embeddings_cache = ([], np.zeros((0, 512), dtype=np.float32))
-            return _embeddings_cache
         try:
-            with open(INDEX_FILE) as f:
-                index = json.load(f)
-            all_names, all_embeddings = [], []
-            for key, value in index.items():
-                student_name = value["name"] if isinstance(value, dict) else key
-                emb_filename = value["file"] if isinstance(value, dict) else value
-                emb_path = ENCODINGS_DIR / emb_filename
-                if emb_path.exists():
-                    embeddings = np.load(str(emb_path))
-                    if embeddings.ndim == 1:
-                        embeddings = embeddings.reshape(1, -1)
-                    all_names.extend([student_name] * embeddings.shape[0])
-                    all_embeddings.append(embeddings)
-            stacked = np.vstack(all_embeddings) if all_embeddings else np.zeros((0, 512), dtype=np.float32)
-            _embeddings_cache = (all_names, stacked)
+            if shared_gallery is not None:
+                _sync_shared_gallery(force_reload)
+            elif _embeddings_cache is None or force_reload:
+                _embeddings_cache_file = embedding_store.data_file
+                _embeddings_cache      = _build_gallery()
         except Exception as e:
             print(f"Embeddings load error: {e}")
-            _embeddings_cache = ([], np.zeros((0, 512), dtype=np.float32))
+            _embeddings_cache = EMPTY_GALLERY
         return _embeddings_cache
 
 
-def invalidate_embeddings_cache():
-    global _embeddings_cache
-    with _embeddings_cache_lock:
-        _embeddings_cache = None
+def _apply_gallery_delta(delta):
+    """Publish ``delta(current_snapshot)`` as the new snapshot.
+
+    Falls back to re-wrapping the store when it was compacted since the
+    current snapshot was built (every offset moved).
+    """
+    global _embeddings_cache, _embeddings_cache_file
+    with _embeddings_cache_lock, (shared_gallery.lock() if shared_gallery else nullcontext()):
+        try:
+            if shared_gallery is not None and shared_gallery.generation() != _embeddings_cache_generation:
+                # Another worker published since; apply on top of its snapshot
+                _sync_shared_gallery()
+            current = _embeddings_cache
+            if current is None:
+                return  # nothing published yet; the first reader builds from the store
+            if embedding_store.data_file != _embeddings_cache_file:
+                _embeddings_cache_file = embedding_store.data_file
+                gallery = _build_gallery()
+            else:
+                gallery = delta(current)
+                if gallery is current:
+                    return
+                if not gallery.indexed:
+                    attach_ann_index(gallery)
+            if shared_gallery is not None:
+                _publish_shared(gallery)
+            _embeddings_cache = gallery
+        except Exception as e:
+            print(f"Embeddings cache update error: {e}")
+            _embeddings_cache = None
+
+
+def gallery_upsert(*student_ids):
+    """Point the cached gallery at students' freshly stored rows."""
+    def delta(gallery):
+        if len(student_ids) > 1:
+            return _build_gallery()   # one re-wrap beats a gallery copy per student
+        student_id = student_ids[0]
+        # Read the store under the cache lock so concurrent saves apply in commit order
+        entry = embedding_store.students().get(str(student_id))
+        if entry is None:
+            return gallery.without(student_id)
+        return gallery.upserted(student_id, entry["name"], entry["offset"], entry["count"],
+                                embedding_store.matrix)
+    _apply_gallery_delta(delta)
+
+
+def gallery_remove(student_id):
+    _apply_gallery_delta(lambda g: g.without(student_id))
+
+
+def gallery_rename(student_id, name):
+    _apply_gallery_delta(lambda g: g.renamed(student_id, name))
+
+# ==================== ANN INDEX ====================
+# Shared by every worker through ann_index.npz: writers hold a file lock and
+# each process reloads the file when its mtime moves.
+_ann_index       = None
+_ann_index_mtime = None
+_ann_lock        = FileLock(ENCODINGS_DIR / ".ann.lock")
+
+
+def _get_ann_index():
+    global _ann_index, _ann_index_mtime
+    try:
+        mtime = ANN_INDEX_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
+        return _ann_index
+    if _ann_index is None or mtime != _ann_index_mtime:
+        try:
+            _ann_index       = IVFIndex.load(ANN_INDEX_FILE)
+            _ann_index_mtime = mtime
+        except Exception as e:
+            print(f"ANN index load error: {e}")
+    return _ann_index
+
+
+def _save_ann_index(index):
+    global _ann_index_mtime
+    if not index.dirty:
+        return  # rewriting an unchanged file would make every worker reload it
+    try:
+        index.save(ANN_INDEX_FILE)
+        _ann_index_mtime = ANN_INDEX_FILE.stat().st_mtime_ns
+    except Exception as e:
+        print(f"ANN index save error: {e}")
+
+
+def attach_ann_index(gallery):
+    """Load (or train) the IVF index for large galleries and search through it."""
+    global _ann_index
+    if ANN_INDEX == "off" or gallery.size == 0:
+        return
+    if ANN_INDEX == "auto" and gallery.size < ANN_MIN_ROWS:
+        return
+    with _ann_lock:
+        index = _get_ann_index()
+        # Retrain once the gallery has outgrown the cell count it was sized for
+        if index is None or gallery.size > 4 * index.trained_rows:
+            index      = IVFIndex.train(gallery.matrix)
+            _ann_index = index
+        gallery.attach_index(index, ANN_NPROBE)
+        _save_ann_index(index)
+
+
+def update_ann_index(changes):
+    """Refresh students' cell assignments; `changes` maps student id to embeddings, or None to drop."""
+    with _ann_lock:
+        index = _get_ann_index()
+        if index is None:
+            return
+        for student_id, embeddings in changes.items():
+            if embeddings is None:
+                index.remove_student(student_id)
+            else:
+                index.update_student(student_id, embeddings)
+        _save_ann_index(index)
 
 # ==================== INSIGHTFACE FUNCTIONS ====================
 
-def detect_faces(image_array):
-    if not insightface_app:
+def _use_tiling(image_array):
+    if TILED_DETECTION == "off":
+        return False
+    return TILED_DETECTION == "on" or max(image_array.shape[:2]) >= TILE_MIN_SIDE
+
+
+def _get_faces(analyzer, image_array):
+    """``analyzer.get``, tiled for large photos, with every face embedded in batches."""
+    if _use_tiling(image_array):
+        bboxes, kpss = detect_tiled(analyzer.det_model, image_array, TILE_SIZE, TILE_OVERLAP)
+    else:
+        bboxes, kpss = analyzer.det_model.detect(image_array, max_num=0, metric="default")
+    return faces_from_detections(analyzer, image_array, bboxes, kpss, EMBED_BATCH_SIZE)
+
+
+def detect_faces(image_array, analyzer=None):
+    analyzer = analyzer or insightface_app
+    if not analyzer:
         return []
     try:
         if len(image_array.shape) == 2:
             image_array = cv2.cvtColor(image_array, cv2.COLOR_GRAY2RGB)
         elif image_array.shape[2] == 4:
             image_array = cv2.cvtColor(image_array, cv2.COLOR_RGBA2RGB)
-        faces = insightface_app.get(image_array)
+        faces = _get_faces(analyzer, image_array)
         return [{
             "bbox":      face.bbox.astype(int).tolist(),
-            "landmarks": face.kps.tolist() if hasattr(face, "kps") and len(face.kps) else [],
+            "landmarks": face.kps.tolist() if face.kps is not None else [],
             "det_score": float(face.det_score),
-            "embedding": face.normed_embedding.tolist() if hasattr(face, "normed_embedding") else None,
+            "embedding": face.normed_embedding.tolist() if face.embedding is not None else None,
         } for face in faces]
     except Exception as e:
         print(f"detect_faces error: {e}")
         return []
 
 
-def extract_embedding(image_array, bbox):
-    if not face_model:
-        return None
+def extract_embeddings(image_array, bboxes, kpss=None, model=None):
+    """Embed many faces of one image, EMBED_BATCH_SIZE crops per model call.
+
+    Faces with landmarks are aligned; the rest use the raw box. Returns one
+    normalised embedding per box, None where the box is empty.
+    """
+    embeddings = [None] * len(bboxes)
+    model = model or face_model
+    if not model:
+        return embeddings
     try:
-        x1, y1, x2, y2 = bbox
-        x1, y1 = max(0, x1), max(0, y1)
-        x2, y2 = min(image_array.shape[1], x2), min(image_array.shape[0], y2)
-        if x2 <= x1 or y2 <= y1:
-            return None
-        face_img = image_array[y1:y2, x1:x2]
-        if face_img.size == 0:
-            return None
-        embedding = face_model.get_feat(face_img)
-        if embedding is not None:
-            return embedding / np.linalg.norm(embedding)
+        crops = [face_crop(image_array, bbox, kpss[i] if kpss is not None else None)
+                 for i, bbox in enumerate(bboxes)]
+        valid = [i for i, crop in enumerate(crops) if crop is not None and crop.size]
+        for i, embedding in zip(valid, embed_crops(model, [crops[i] for i in valid], EMBED_BATCH_SIZE)):
+            embeddings[i] = embedding
     except Exception as e:
-        print(f"extract_embedding error: {e}")
-    return None
+        print(f"extract_embeddings error: {e}")
+    return embeddings
 
 
-def cosine_similarity(a, b):
-    if b.size == 0:
-        return np.array([])
-    a_norm = a / (np.linalg.norm(a) + 1e-10)
-    b_norm = b / (np.linalg.norm(b, axis=1, keepdims=True) + 1e-10)
-    return np.dot(b_norm, a_norm).flatten()
+def save_student_embeddings(student_id, student_name, embeddings):
+    return save_students_embeddings([(student_id, student_name, embeddings)])
 
 
-def save_student_embeddings(student_id, student_name, embeddings):
+def save_students_embeddings(entries):
+    """Store ``(student_id, name, embeddings)`` entries with one table write and one publish."""
     try:
-        emb_filename = f"{student_id}.npy"
-        np.save(str(ENCODINGS_DIR / emb_filename), embeddings.astype(np.float32))
-        index = {}
-        if INDEX_FILE.exists():
-            with open(INDEX_FILE) as f:
-                index = json.load(f)
-        index[str(student_id)] = {"name": student_name, "file": emb_filename}
-        with open(INDEX_FILE, "w") as f:
-            json.dump(index, f, indent=2)
+        embedding_store.put_many(entries)
+        update_ann_index({student_id: embeddings for student_id, _, embeddings in entries})
+        gallery_upsert(*[student_id for student_id, _, _ in entries])
+        attendance_stats.set_face_counts(get_db(), {oid(student_id): len(embeddings)
+                                                    for student_id, _, embeddings in entries})
         return True
     except Exception as e:
-        print(f"save_student_embeddings error: {e}")
+        print(f"save_students_embeddings error: {e}")
         return False
 
 
+def delete_student_embeddings(student_id):
+    try:
+        embedding_store.delete(student_id)
+        update_ann_index({student_id: None})
+        gallery_remove(student_id)
+        attendance_stats.set_face_counts(get_db(), {oid(student_id): 0})
+        return True
+    except Exception as e:
+        print(f"delete_student_embeddings error: {e}")
+        return False
+
+
+def _analyze_faces(analyzer, img_rgb):
+    """Detect and embed every face on one pool replica, in batched model calls."""
+    faces   = detect_faces(img_rgb, analyzer)
+    pending = [i for i, face in enumerate(faces) if not face.get("embedding")]
+    late    = extract_embeddings(img_rgb, [faces[i]["bbox"] for i in pending],
+                                 [faces[i]["landmarks"] or None for i in pending],
+                                 analyzer.models["recognition"])
+    embeddings = [np.array(face["embedding"]) if face.get("embedding") else None for face in faces]
+    for i, embedding in zip(pending, late):
+        embeddings[i] = embedding
+    return faces, embeddings
+
+
 def recognize_face_in_image(image_path, threshold=RECOGNITION_THRESHOLD):
+    """Recognise every face in a photo; raises PoolBusy when inference is saturated.
+
+    The photo is decoded once into RGB, which detection uses directly. The
+    result is stored under a ``result_id``; its annotated image is only drawn
+    when first requested (see `render_annotated`). ``timings`` (ms) and
+    ``memory`` (MB) cover this request only.
+    """
+    results = recognize_photos([image_path], threshold)
+    if not results["success"]:
+        return results
+    result = results["photos"][0]
+    if not result.get("success"):
+        return result
+    result["timings"] = results["timings"]
+    result["memory"]  = results["memory"]
+    return result
+
+
+def _match_candidates(gallery, embeddings):
+    """Top-k candidates per face (``[]`` where there is no embedding), in one product."""
+    with_emb   = [i for i, emb in enumerate(embeddings) if emb is not None]
+    candidates = [[] for _ in embeddings]
+    if with_emb:
+        matches = gallery.match(np.vstack([embeddings[i] for i in with_emb]), k=RECOGNITION_TOP_K)
+        for i, face_matches in zip(with_emb, matches):
+            candidates[i] = face_matches
+    return candidates
+
+
+def _recognition_entry(face, face_candidates, threshold):
+    best = face_candidates[0] if face_candidates and face_candidates[0]["score"] >= threshold else None
+    return {
+        "student_id": best["student_id"] if best else None,
+        "name":       best["name"] if best else "Unknown",
+        "confidence": best["score"] if best else 0.0,
+        "bbox":       face["bbox"],
+        "candidates": [{"name": c["name"], "score": c["score"]} for c in face_candidates],
+    }
+
+
+def recognize_photos(image_paths, threshold=RECOGNITION_THRESHOLD):
+    """Recognise several photos of one class as a batch; raises PoolBusy when saturated.
+
+    Photos are decoded, then detected and embedded concurrently on the pool's
+    replicas, and every face of every photo is scored against the gallery in
+    a single product. Each entry of ``photos`` is shaped like a single
+    `recognize_face_in_image` result (or ``success: False`` with an error);
+    ``timings`` and ``memory`` cover the whole batch.
+    """
     if not insightface_app:
         return {"success": False, "error": "InsightFace not initialised"}
 
-    names_db, vecs_db = load_all_embeddings()
-    if vecs_db.size == 0:
+    gallery = load_all_embeddings()
+    if gallery.size == 0:
         return {"success": False, "error": "No embeddings found. Encode faces first."}
 
+    timings = {}
+    started = time.perf_counter()
+    images  = []
+    for image_path in image_paths:
+        try:
+            images.append(load_image_rgb(image_path, DECODE_MAX_SIDE, DECODE_FULL_FROM))
+        except Exception:
+            images.append(None)
+    timings["decode"] = time.perf_counter() - started
+
+    started  = time.perf_counter()
+    decoded  = [img for img in images if img is not None]
+    if len(decoded) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(decoded), INFERENCE_WORKERS)) as fan_out:
+            analysed = list(fan_out.map(lambda img: inference_pool.run(_analyze_faces, img), decoded))
+    else:
+        analysed = [inference_pool.run(_analyze_faces, img) for img in decoded]
+    timings["inference"] = time.perf_counter() - started
+
+    started    = time.perf_counter()
+    candidates = iter(_match_candidates(gallery, [emb for _, embeddings in analysed for emb in embeddings]))
+    timings["match"] = time.perf_counter() - started
+
+    photos   = []
+    analysed = iter(analysed)
+    for image_path, img_rgb in zip(image_paths, images):
+        if img_rgb is None:
+            photos.append({"success": False, "error": "Failed to read image"})
+            continue
+        faces, _ = next(analysed)
+        recognitions = [_recognition_entry(face, next(candidates), threshold) for face in faces]
+        if not faces:
+            photos.append({"success": False, "error": "No faces detected"})
+            continue
+        result = {
+            "success":      True,
+            "faces_found":  len(faces),
+            "recognized":   sum(rec["student_id"] is not None for rec in recognitions),
+            "recognitions": recognitions,
+            "image_size":   [img_rgb.shape[1], img_rgb.shape[0]],
+        }
+        result["result_id"] = save_recognition_result(image_path, result)
+        photos.append(result)
+
+    return {
+        "success": True,
+        "photos":  photos,
+        "timings": {k: round(v * 1000, 1) for k, v in timings.items()},
+        "memory":  {"decoded_mb": round(sum(img.nbytes for img in decoded) / 1e6, 1)},
+    }
+
+# ==================== STUDENT STATISTICS ====================
+# attendance_count and face_count are maintained by the writes that change
+# them (`_mark_present`, session reset/delete, embedding saves). This job
+# recounts both to repair drift, e.g. from records edited by hand or from
+# concurrent writers to one session. Every process starts the loop on its
+# first request, so it also runs under WSGI servers; a lock file lets only
+# one of them recount at a time, and another takes over if it exits.
+_reconcile_started_pid = None
+_reconcile_start_lock  = threading.Lock()
+_reconcile_leader      = None   # open lock file, held by the process that recounts
+
+def reconcile_student_statistics():
     try:
-        pil_image = ImageOps.exif_transpose(Image.open(str(image_path)))
-        img_bgr   = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-    except Exception:
-        img_bgr = cv2.imread(str(image_path))
-        if img_bgr is None:
-            return {"success": False, "error": "Failed to read image"}
-
-    img_rgb  = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-    faces    = detect_faces(img_rgb)
-    if not faces:
-        return {"success": False, "error": "No faces detected"}
-
-    annotated    = img_bgr.copy()
-    recognitions = []
-    marked_count = 0
-
-    for face in faces:
-        bbox = face["bbox"]
-        x1, y1, x2, y2 = bbox
-        emb  = np.array(face["embedding"]) if face.get("embedding") else extract_embedding(img_rgb, bbox)
-        name = "Unknown"
-        confidence = 0.0
-
-        if emb is not None and vecs_db.size > 0:
-            sims = cosine_similarity(emb, vecs_db)
-            if sims.size:
-                best_idx = np.argmax(sims)
-                best_sim = sims[best_idx]
-                if best_sim >= threshold:
-                    name       = names_db[best_idx]
-                    confidence = float(best_sim)
-                    marked_count += 1
-
-        color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
+        face_counts = {sid: entry["count"] for sid, entry in embedding_store.students().items()}
+        fixed = attendance_stats.reconcile_counters(get_db(), face_counts)
+        if fixed:
+            print(f"🔧 Reconciled statistics of {fixed} students")
+        return fixed
+    except Exception as e:
+        print(f"reconcile_student_statistics error: {e}")
+        return None
+
+
+def _is_reconcile_leader():
+    global _reconcile_leader
+    if _reconcile_leader is None:
+        handle = open(ENCODINGS_DIR / ".reconcile.lock", "a")
+        if FCNTL_AVAILABLE:
+            import fcntl
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                return False
+        _reconcile_leader = handle
+    return True
+
+
+def _reconcile_statistics_loop():
+    while True:
+        time.sleep(RECONCILE_SECONDS)
+        if _is_reconcile_leader():
+            reconcile_student_statistics()
+
+
+@app.before_request
+def _start_reconcile_loop():
+    global _reconcile_started_pid
+    if RECONCILE_SECONDS <= 0 or _reconcile_started_pid == os.getpid():
+        return
+    with _reconcile_start_lock:
+        if _reconcile_started_pid != os.getpid():   # once per process, including forked workers
+            _reconcile_started_pid = os.getpid()
+            threading.Thread(target=_reconcile_statistics_loop, daemon=True).start()
+
+# ==================== RECOGNITION RESULTS ====================
+# A recognition result is kept as a small JSON record next to the photo it
+# came from. The annotated image and its thumbnail are drawn the first time
+# the UI asks for them and then served from disk, so /recognize itself never
+# encodes an image.
+
+def _result_file(result_id, suffix=".json"):
+    if not (len(result_id) == 32 and all(c in "0123456789abcdef" for c in result_id)):
+        return None
+    return RESULTS_DIR / f"{result_id}{suffix}"
+
+
+def save_recognition_result(image_path, result):
+    result_id = uuid.uuid4().hex
+    record    = {
+        "result_id":    result_id,
+        "source":       str(image_path),
+        "image_size":   result["image_size"],
+        "recognitions": [{k: r[k] for k in ("student_id", "name", "confidence", "bbox")}
+                         for r in result["recognitions"]],
+        "created_at":   datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with open(_result_file(result_id), "w") as f:
+        json.dump(record, f)
+    return result_id
+
+
+def load_recognition_result(result_id):
+    path = _result_file(result_id)
+    if path is None or not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def render_annotated(result_id):
+    """Path of the result's annotated JPEG, drawing it on first use; None if unknown."""
+    path = _result_file(result_id, ".jpg")
+    if path is None:
+        return None
+    if path.exists():
+        return path
+    record = load_recognition_result(result_id)
+    if record is None or not Path(record["source"]).exists():
+        return None
+
+    annotated = cv2.cvtColor(load_image_rgb(record["source"], DECODE_MAX_SIDE, DECODE_FULL_FROM),
+                             cv2.COLOR_RGB2BGR)
+    # Boxes are in the coordinates of the decode recognition used
+    sx = annotated.shape[1] / record["image_size"][0]
+    sy = annotated.shape[0] / record["image_size"][1]
+    for rec in record["recognitions"]:
+        x1, y1, x2, y2 = (int(round(v * s)) for v, s in zip(rec["bbox"], (sx, sy, sx, sy)))
+        color = (0, 255, 0) if rec["student_id"] is not None else (0, 0, 255)
         cv2.rectangle(annotated, (x1, y1), (x2, y2), color, 2)
-        cv2.putText(annotated, f"{name} ({confidence:.2f})", (x1, y1 - 10),
+        cv2.putText(annotated, f"{rec['name']} ({rec['confidence']:.2f})", (x1, y1 - 10),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-        recognitions.append({"name": name, "confidence": confidence, "bbox": bbox})
 
-    ts           = datetime.now().strftime("%Y%m%d_%H%M%S")
-    clean_name   = image_path.stem.lstrip("annotated_")
-    ann_filename = f"annotated_{clean_name}_{ts}.jpg"
-    ann_path     = UPLOADS_DIR / ann_filename
-    cv2.imwrite(str(ann_path), annotated)
-    save_thumbnail(ann_path)
+    return _replace_atomically(path, lambda tmp: cv2.imwrite(str(tmp), annotated))
 
-    _, buf = cv2.imencode(".jpg", annotated)
+
+def result_urls(result_id):
     return {
-        "success":            True,
-        "faces_found":        len(faces),
-        "recognized":         marked_count,
-        "recognitions":       recognitions,
-        "annotated_image":    f"data:image/jpeg;base64,{base64.b64encode(buf).decode()}",
-        "annotated_path":     str(ann_path),
-        "annotated_filename": ann_filename,
+        "annotated_url": f"/results/{result_id}/annotated.jpg",
+        "thumbnail_url": f"/results/{result_id}/thumb.jpg",
     }
 
 
-def cleanup_old_annotated_files(max_files=20):
-    try:
-        files = sorted(UPLOADS_DIR.glob("annotated_*.jpg"), key=lambda x: x.stat().st_mtime)
-        for f in files[:-max_files]:
+def delete_recognition_result(record):
+    """Remove a result's record, annotated image and thumbnail."""
+    for f in (record, record.with_suffix(".jpg"), THUMB_DIR / f"thumb_{record.stem}.jpg"):
+        if f.exists():
             f.unlink()
-            thumb = THUMB_DIR / f"thumb_{f.name}"
-            if thumb.exists():
-                thumb.unlink()
-    except Exception as e:
-        print(f"cleanup error: {e}")
 
 
-def update_student_statistics():
-    db = get_db()
-    if INDEX_FILE.exists():
-        with open(INDEX_FILE) as f:
-            index = json.load(f)
-        for sid_str, info in index.items():
-            emb_file = ENCODINGS_DIR / (info["file"] if isinstance(info, dict) else info)
-            if emb_file.exists():
-                data       = np.load(str(emb_file))
-                face_count = data.shape[0] if data.ndim > 1 else 1
-                db.students.update_one(
-                    {"_id": oid(sid_str)},
-                    {"$set": {"face_count": face_count}}
-                )
-    for student in db.students.find():
-        present = db.attendance.count_documents({"student_id": student["_id"], "status": "present"})
-        db.students.update_one({"_id": student["_id"]}, {"$set": {"attendance_count": present}})
+def cleanup_old_results(max_results=200):
+    """Keep the newest `max_results` results (record, annotated image, thumbnail)."""
+    try:
+        records = sorted(RESULTS_DIR.glob("*.json"), key=lambda x: x.stat().st_mtime)
+        for record in records[:-max_results]:
+            delete_recognition_result(record)
+    except Exception as e:
+        print(f"cleanup error: {e}")
 
 # ==================== BACKGROUND ENCODING ====================
 _encoding_progress = {"running": False, "progress": 0, "total": 0, "done": 0, "status": "idle", "error": None}
 _encoding_lock     = threading.Lock()
+crop_cache         = encoding_pipeline.CropCache(ENCODINGS_DIR / "crops")
+# Encoded students are written to the store together, at most this often, so
+# a run costs a handful of table writes rather than one per student
+ENCODING_FLUSH_SECONDS = 5
+
+
+def _encoded_students(tasks):
+    """Yield ``(student_id, {filename: embedding or None})`` per task, in completion order.
+
+    Tasks are ``(folder, filenames, known_embeddings, digests)``. With
+    ENCODING_PROCESSES > 1 they run in batches on a pool of worker processes,
+    each with its own model replica; otherwise one student at a time on the
+    inference pool, waiting for a free replica like any other caller.
+    """
+    if ENCODING_PROCESSES <= 1 or len(tasks) <= ENCODING_BATCH:
+        for folder, filenames, known, digests in tasks:
+            while True:
+                try:
+                    embedded = inference_pool.run(encoding_pipeline.embed_images, folder, filenames,
+                                                  ENCODING_MAX_SIDE, known, digests, crop_cache,
+                                                  EMBED_BATCH_SIZE)
+                    break
+                except PoolBusy as e:
+                    time.sleep(e.retry_after)
+            yield folder.name, embedded
+        return
+    modules = INSIGHTFACE_PROFILES.get(INSIGHTFACE_PROFILE, INSIGHTFACE_PROFILES["recognition"])
+    for folder, embedded in encoding_pipeline.encode_in_processes(
+            tasks, ENCODING_PROCESSES, ENCODING_BATCH, (INSIGHTFACE_MODEL, modules, INSIGHTFACE_DET_SIZE),
+            ENCODING_MAX_SIDE, crop_cache, EMBED_BATCH_SIZE):
+        yield folder.name, embedded
 
 
 def _run_encoding_thread():
+    """Bring the store in line with dataset/, embedding only new or changed images."""
     global _encoding_progress
     try:
         folders = [d for d in DATASET_DIR.iterdir() if d.is_dir()]
@@ -383,46 +900,75 @@ def _run_encoding_thread():
         with _encoding_lock:
             _encoding_progress.update({"running": True, "progress": 0, "total": total,
                                        "done": 0, "status": "running", "error": None,
-                                       "message": "Starting…"})
+                                       "message": "Checking for changed photos…"})
+
+        manifest = encoding_pipeline.EncodingManifest(ENCODINGS_DIR / "manifest.json", ENCODING_MODEL_ID)
+        manifest.retain({folder.name for folder in folders})
+        crop_cache.retain({folder.name for folder in folders})
+        plans, tasks = {}, []
+        for folder in folders:
+            stored = embedding_store.get(folder.name)
+            stored = np.array(stored) if stored is not None else None
+            images, keep, todo = manifest.plan(folder, stored)
+            if manifest.unchanged(folder.name, images, todo):
+                manifest.refresh(folder.name, images)
+                continue
+            kept_rows = [row for row in keep.values() if row is not None]
+            plans[folder.name] = (folder, images, keep, stored)
+            tasks.append((folder, todo, stored[kept_rows] if kept_rows else None,
+                          {name: meta["sha1"] for name, meta in images.items()}))
+
+        done      = total - len(tasks)
         total_emb = 0
         processed = 0
-        for i, folder in enumerate(folders):
-            student_id_str = folder.name
-            name_file      = folder / "name.txt"
-            student_name   = name_file.read_text(encoding="utf-8").strip() if name_file.exists() else student_id_str
-
-            embeddings = []
-            for ext in ["*.jpg", "*.jpeg", "*.png", "*.JPG", "*.JPEG", "*.PNG"]:
-                for img_path in folder.glob(ext):
-                    try:
-                        arr   = np.array(Image.open(str(img_path)).convert("RGB"))
-                        faces = detect_faces(arr)
-                        if faces:
-                            face = faces[0]
-                            emb  = np.array(face["embedding"]) if face.get("embedding") else extract_embedding(arr, face["bbox"])
-                            if emb is not None:
-                                embeddings.append(emb)
-                                total_emb += 1
-                    except Exception as e:
-                        print(f"Encoding error ({img_path}): {e}")
+        pending   = []   # (student_id, name, embeddings, images, rows) awaiting one store write
+        flushed   = time.monotonic()
+
+        def flush():
+            if pending and save_students_embeddings([entry[:3] for entry in pending]):
+                for student_id, _, _, images, rows in pending:
+                    manifest.record(student_id, images, rows, embedding_store.get(student_id))
+            pending.clear()
+
+        for student_id_str, embedded in _encoded_students(tasks):
+            folder, images, keep, stored = plans[student_id_str]
+            student_name = encoding_pipeline.folder_name(folder)
+            embeddings, rows = [], {}
+            for filename in sorted(images):
+                if filename in keep:
+                    emb = stored[keep[filename]] if keep[filename] is not None else None
+                else:
+                    emb = embedded.get(filename)
+                if emb is not None:
+                    rows[filename] = len(embeddings)
+                    embeddings.append(emb)
 
             if embeddings:
-                save_student_embeddings(student_id_str, student_name, np.vstack(embeddings))
+                pending.append((student_id_str, student_name, np.vstack(embeddings), images, rows))
                 processed += 1
-
+            # Rows are only dropped once the manifest shows they came from these photos
+            elif (stored is None or student_id_str not in manifest.students
+                  or delete_student_embeddings(student_id_str)):
+                manifest.record(student_id_str, images, rows, embedding_store.get(student_id_str))
+            total_emb += sum(emb is not None for emb in embedded.values())
+            if time.monotonic() - flushed >= ENCODING_FLUSH_SECONDS:
+                flush()
+                flushed = time.monotonic()
+
+            done += 1
             with _encoding_lock:
-                done = i + 1
                 _encoding_progress.update({
                     "done":     done,
                     "progress": int(done / total * 100) if total else 100,
                     "message":  f"Processing {student_name}… ({done}/{total})",
                 })
 
-        invalidate_embeddings_cache()
-        update_student_statistics()
+        flush()
+        manifest.save()
         with _encoding_lock:
             _encoding_progress.update({"running": False, "progress": 100, "status": "complete",
-                                       "message": f"Encoded {total_emb} faces for {processed} students."})
+                                       "message": f"Encoded {total_emb} new faces for {processed} students; "
+                                                  f"{total - len(tasks)} unchanged."})
     except Exception as e:
         with _encoding_lock:
             _encoding_progress.update({"running": False, "status": "error",
@@ -461,6 +1007,24 @@ def uploaded_file(filename):
 def uploaded_thumb(filename):
     return send_from_directory(THUMB_DIR, filename)
 
+@app.route("/results/<result_id>/annotated.jpg")
+@login_required
+def result_annotated(result_id):
+    path = render_annotated(result_id)
+    if path is None:
+        return jsonify({"success": False, "error": "Result not found"}), 404
+    return send_from_directory(RESULTS_DIR, path.name, max_age=86400)
+
+@app.route("/results/<result_id>/thumb.jpg")
+@login_required
+def result_thumbnail(result_id):
+    path = render_annotated(result_id)
+    if path is None:
+        return jsonify({"success": False, "error": "Result not found"}), 404
+    if not (THUMB_DIR / f"thumb_{path.name}").exists():
+        save_thumbnail(path)
+    return send_from_directory(THUMB_DIR, f"thumb_{path.name}", max_age=86400)
+
 # ==================== AUTH ROUTES ====================
 
 @app.route("/", methods=["GET", "POST"])
@@ -503,46 +1067,7 @@ def logout():
 def index():
     db    = get_db()
     today = datetime.now().strftime("%Y-%m-%d")
-
-    today_session_ids = [s["_id"] for s in db.sessions.find({"date": today})]
-    stats = {
-        "total_students":   db.students.count_documents({}),
-        "today_sessions":   len(today_session_ids),
-        "today_attendance": db.attendance.count_documents(
-            {"session_id": {"$in": today_session_ids}, "status": "present"}
-        ) if today_session_ids else 0,
-        "total_attendance": db.attendance.count_documents({"status": "present"}),
-    }
-
-    top_students = []
-    for student in db.students.find():
-        total = db.attendance.count_documents({"student_id": student["_id"]})
-        if total == 0:
-            continue
-        present = db.attendance.count_documents({"student_id": student["_id"], "status": "present"})
-        top_students.append({
-            "name":          student["name"],
-            "department":    student.get("department"),
-            "present_count": present,
-            "total_count":   total,
-            "percentage":    round(present / total * 100, 1),
-        })
-    top_students = sorted(top_students, key=lambda x: x["percentage"], reverse=True)[:5]
-
-    recent_sessions = []
-    for s in db.sessions.find().sort("date", -1).limit(5):
-        subject = db.subjects.find_one({"_id": s["subject_id"]}) or {}
-        teacher = db.users.find_one({"_id": s["teacher_id"]}) or {}
-        present = db.attendance.count_documents({"session_id": s["_id"], "status": "present"})
-        recent_sessions.append({
-            "id":            str(s["_id"]),
-            "date":          s["date"],
-            "start_time":    s["start_time"],
-            "end_time":      s["end_time"],
-            "subject_name":  subject.get("subject_name", ""),
-            "teacher_name":  teacher.get("full_name", ""),
-            "present_count": present,
-        })
+    dashboard_data = attendance_stats.dashboard(db, today)
 
     subjects = list(db.subjects.find().sort("subject_name", 1))
     teachers = list(db.users.find({"role": "teacher"}).sort("full_name", 1))
@@ -550,12 +1075,10 @@ def index():
         doc["id"] = str(doc["_id"])
 
     return render_template("index.html",
-                           stats=stats,
-                           top_students=top_students,
-                           recent_sessions=recent_sessions,
+                           **dashboard_data,
                            subjects=subjects,
                            teachers=teachers,
-                           encodings_exist=INDEX_FILE.exists() and INDEX_FILE.stat().st_size > 0,
+                           encodings_exist=bool(embedding_store.students()),
                            insightface_available=INSIGHTFACE_AVAILABLE and insightface_app is not None)
 
 
@@ -611,111 +1134,633 @@ def upload_photo():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def _resolve_legacy_student(db, name):
+    """Find (or create) the student for a gallery entry whose key is not an ObjectId."""
+    student = db.students.find_one({"name": name})
+    if student:
+        return student["_id"]
+    new_id = db.students.insert_one({
+        "name": name, "roll_no": None, "department": None,
+        "year": None, "face_count": 0, "attendance_count": 0,
+        "created_at": datetime.now(),
+    }).inserted_id
+    student_dir = DATASET_DIR / str(new_id)
+    student_dir.mkdir(parents=True, exist_ok=True)
+    (student_dir / "name.txt").write_text(name, encoding="utf-8")
+    return new_id
+
+
+def _get_or_create_session(db, subject_id, teacher_id):
+    """The session for this subject and teacher started this minute.
+
+    Sessions are keyed by date and HH:MM start time (ending an hour later),
+    so captures within the same minute share one session and a later minute
+    opens a new one.
+    """
+    today       = datetime.now().strftime("%Y-%m-%d")
+    start       = datetime.now().strftime("%H:%M")
+    end         = (datetime.now() + timedelta(hours=1)).strftime("%H:%M")
+    subj_oid    = oid(subject_id)
+    teacher_oid = oid(teacher_id)
+
+    existing = db.sessions.find_one({
+        "subject_id": subj_oid, "teacher_id": teacher_oid,
+        "date": today, "start_time": start, "end_time": end,
+    })
+    if existing:
+        return existing["_id"]
+    return db.sessions.insert_one({
+        "subject_id": subj_oid, "teacher_id": teacher_oid,
+        "date": today, "start_time": start, "end_time": end,
+        "created_at": datetime.now(),
+    }).inserted_id
+
+
+def _student_oid(db, student_id, name):
+    # The gallery is keyed by student ObjectId; only legacy (pre-ObjectId)
+    # dataset folders still need resolving by name.
+    student_oid = oid(student_id)
+    if student_oid is None:
+        student_oid = _resolve_legacy_student(db, name)
+    return student_oid
+
+
+def _mark_present(db, session_id, student_id, name, confidence):
+    """Upsert a present record; returns the student's ObjectId.
+
+    The student's attendance_count goes up only when the record was not
+    already present.
+    """
+    student_oid = _student_oid(db, student_id, name)
+    before = db.attendance.find_one_and_update(
+        {"session_id": session_id, "student_id": student_oid},
+        {"$set": {"status": "present", "confidence": confidence,
+                  "marked_at": datetime.now()}},
+        projection={"status": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE,
+    )
+    if (before or {}).get("status") != "present":
+        attendance_stats.adjust_attendance_counts(db, [student_oid], 1)
+    return student_oid
+
+
+def _commit_attendance(subject_id, teacher_id, recognitions, threshold, photo_name, faces_found):
+    """Write a session's attendance from recognised faces.
+
+    Each student is marked present once, with their best confidence, and
+    the rest of the subject's roster absent, in bulk (see attendance_writer);
+    the timeline is updated once. Returns ``(session_id, names, write_stats)``.
+    """
+    db         = get_db()
+    session_id = _get_or_create_session(db, subject_id, teacher_id)
+
+    best = {}
+    for rec in recognitions:
+        if rec["student_id"] is None or rec["confidence"] < threshold:
+            continue
+        if rec["student_id"] not in best or rec["confidence"] > best[rec["student_id"]]["confidence"]:
+            best[rec["student_id"]] = rec
+
+    present = {_student_oid(db, rec["student_id"], rec["name"]): rec["confidence"] for rec in best.values()}
+    marked_students = [rec["name"] for rec in best.values()]
+    write = attendance_writer.write_session(db, session_id, present,
+                                            attendance_writer.roster(db, oid(subject_id)))
+
+    subject = db.subjects.find_one({"_id": oid(subject_id)}) or {}
+    teacher = db.users.find_one({"_id": oid(teacher_id)}) or {}
+    append_to_timeline(photo_name, len(marked_students), faces_found,
+                       subject.get("subject_name", ""), teacher.get("full_name", ""))
+    cleanup_old_results()
+    return session_id, marked_students, write
+
+
+def _mark_absentees(db, session_id):
+    """Seed "absent" for everyone on the session's roster without a record yet."""
+    sess = db.sessions.find_one({"_id": session_id}, {"subject_id": 1}) or {}
+    return attendance_writer.write_session(db, session_id, {},
+                                           attendance_writer.roster(db, sess.get("subject_id")))
+
+
+def _save_recognition_upload(file):
+    filename = f"recognize_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.jpg"
+    filepath = UPLOADS_DIR / filename
+    file.save(str(filepath))
+    return filepath
+
+
+def _recognition_params():
+    """Photo and options of a /recognize-style form, as ``(params, error)``."""
+    if "image" in request.files:
+        file = request.files["image"]
+        if not (file and allowed_file(file.filename)):
+            return None, "Invalid image"
+        latest_photo = _save_recognition_upload(file)
+    else:
+        photos = [f for f in list(UPLOADS_DIR.glob("*.jpg")) + list(UPLOADS_DIR.glob("*.png"))
+                  if not f.name.startswith("annotated_")]
+        if not photos:
+            return None, "No photos found. Capture first."
+        latest_photo = max(photos, key=lambda f: f.stat().st_ctime)
+
+    subject_id = request.form.get("subject_id")
+    if not subject_id:
+        return None, "Please select a subject"
+    return {
+        "photo":      latest_photo,
+        "subject_id": subject_id,
+        "teacher_id": request.form.get("teacher_id", session.get("user_id")),
+        "threshold":  float(request.form.get("threshold", RECOGNITION_THRESHOLD)),
+    }, None
+
+
+def mark_attendance_from_photo(photo, subject_id, teacher_id, threshold):
+    """Recognise a class photo and mark its session's attendance.
+
+    Returns ``(payload, http_status)``; raises PoolBusy when inference is saturated.
+    """
+    result = recognize_face_in_image(photo, threshold=threshold)
+    if not result.get("success"):
+        return result, 400
+
+    session_id, marked_students, write = _commit_attendance(
+        subject_id, teacher_id, result["recognitions"], threshold, photo.name, result["faces_found"])
+
+    return {
+        "success":         True,
+        "message":         f"Attendance marked for {len(marked_students)} students",
+        "session_id":      str(session_id),
+        "faces_found":     result["faces_found"],
+        "recognized":      len(marked_students),
+        "result_id":       result["result_id"],
+        **result_urls(result["result_id"]),
+        "faces":           [{k: r[k] for k in ("student_id", "name", "confidence", "bbox")}
+                            for r in result["recognitions"]],
+        "image_size":      result["image_size"],
+        "marked_students": marked_students,
+        "attendance":      write,
+        "timings":         {**result["timings"], "attendance": write["ms"]},
+        "memory":          result["memory"],
+    }, 200
+
+
+def mark_attendance_from_photos(photos, subject_id, teacher_id, threshold):
+    """Recognise several photos of one class and mark its attendance once.
+
+    A student seen in more than one photo counts once, with the best
+    confidence. Returns ``(payload, http_status)``; raises PoolBusy when
+    inference is saturated.
+    """
+    results = recognize_photos(photos, threshold=threshold)
+    if not results.get("success"):
+        return results, 400
+    recognised = [result for result in results["photos"] if result.get("success")]
+    if not recognised:
+        return {"success": False, "error": "No faces detected in any photo"}, 400
+
+    faces_found = sum(result["faces_found"] for result in recognised)
+    session_id, marked_students, write = _commit_attendance(
+        subject_id, teacher_id, [rec for result in recognised for rec in result["recognitions"]],
+        threshold, f"{photos[0].name} (+{len(photos) - 1})" if len(photos) > 1 else photos[0].name,
+        faces_found)
+
+    per_photo = []
+    for photo, result in zip(photos, results["photos"]):
+        if not result.get("success"):
+            per_photo.append({"photo": photo.name, "success": False, "error": result["error"]})
+            continue
+        per_photo.append({
+            "photo":       photo.name,
+            "success":     True,
+            "faces_found": result["faces_found"],
+            "recognized":  result["recognized"],
+            "result_id":   result["result_id"],
+            **result_urls(result["result_id"]),
+            "faces":       [{k: r[k] for k in ("student_id", "name", "confidence", "bbox")}
+                            for r in result["recognitions"]],
+            "image_size":  result["image_size"],
+        })
+
+    return {
+        "success":         True,
+        "message":         f"Attendance marked for {len(marked_students)} students from {len(photos)} photos",
+        "session_id":      str(session_id),
+        "faces_found":     faces_found,
+        "recognized":      len(marked_students),
+        "photos":          per_photo,
+        "marked_students": marked_students,
+        "attendance":      write,
+        "timings":         {**results["timings"], "attendance": write["ms"]},
+        "memory":          results["memory"],
+    }, 200
+
+
+def _busy_response(retry_after, error):
+    response = jsonify({"success": False, "error": error, "retry_after": retry_after})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 503
+
+
 @app.route("/recognize", methods=["POST"])
 @login_required
 @role_required("admin", "teacher")
 def recognize():
     try:
-        if "image" in request.files:
-            file = request.files["image"]
-            if not (file and allowed_file(file.filename)):
-                return jsonify({"success": False, "error": "Invalid image"}), 400
-            filename = f"recognize_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-            filepath = UPLOADS_DIR / filename
-            file.save(str(filepath))
-            latest_photo = filepath
-        else:
-            photos = [f for f in list(UPLOADS_DIR.glob("*.jpg")) + list(UPLOADS_DIR.glob("*.png"))
-                      if not f.name.startswith("annotated_")]
-            if not photos:
-                return jsonify({"success": False, "error": "No photos found. Capture first."}), 400
-            latest_photo = max(photos, key=lambda f: f.stat().st_ctime)
+        params, error = _recognition_params()
+        if error:
+            return jsonify({"success": False, "error": error}), 400
+        if not INSIGHTFACE_AVAILABLE or not insightface_app:
+            return jsonify({"success": False, "error": "Face recognition not available"}), 500
+        payload, status = mark_attendance_from_photo(**params)
+        return jsonify(payload), status
+    except PoolBusy as e:
+        return _busy_response(e.retry_after, str(e))
+    except Exception as e:
+        print(f"Recognition error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route("/recognize_batch", methods=["POST"])
+@login_required
+@role_required("admin", "teacher")
+def recognize_batch():
+    try:
+        files = [f for f in request.files.getlist("images") if f and f.filename]
+        if not files:
+            return jsonify({"success": False, "error": "No images uploaded"}), 400
+        if len(files) > RECOGNIZE_BATCH_MAX:
+            return jsonify({"success": False,
+                            "error": f"At most {RECOGNIZE_BATCH_MAX} photos per batch"}), 400
+        if not all(allowed_file(f.filename) for f in files):
+            return jsonify({"success": False, "error": "Invalid image"}), 400
         subject_id = request.form.get("subject_id")
-        teacher_id = request.form.get("teacher_id", session.get("user_id"))
-        threshold  = float(request.form.get("threshold", RECOGNITION_THRESHOLD))
-
         if not subject_id:
             return jsonify({"success": False, "error": "Please select a subject"}), 400
         if not INSIGHTFACE_AVAILABLE or not insightface_app:
             return jsonify({"success": False, "error": "Face recognition not available"}), 500
+        payload, status = mark_attendance_from_photos(
+            [_save_recognition_upload(f) for f in files], subject_id,
+            request.form.get("teacher_id", session.get("user_id")),
+            float(request.form.get("threshold", RECOGNITION_THRESHOLD)))
+        return jsonify(payload), status
+    except PoolBusy as e:
+        return _busy_response(e.retry_after, str(e))
+    except Exception as e:
+        print(f"Batch recognition error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
-        result = recognize_face_in_image(latest_photo, threshold=threshold)
-        if not result.get("success"):
-            return jsonify(result), 400
+# ==================== RECOGNITION JOBS ====================
+# POST /api/recognition_jobs takes the same form as /recognize, answers 202 with
+# a job id at once and leaves the work to a background pool; clients poll
+# GET /api/recognition_jobs/<job_id>. Jobs live in MongoDB, so any worker
+# process can answer the poll, and expire after a day (TTL index). The process
+# holding a job refreshes its heartbeat_at; a queued or running job whose
+# heartbeat stopped (its worker was restarted or killed) is reported failed.
+_job_executor  = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="recognition-job")
+_jobs_pending  = 0
+_jobs_active   = set()   # ids of this process's unfinished jobs
+_jobs_lock     = threading.Lock()
+_job_heartbeat = None
+JOB_HEARTBEAT_SECONDS = 15
+JOB_STALE_SECONDS     = 4 * JOB_HEARTBEAT_SECONDS
+
+
+def _job_heartbeat_loop():
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        with _jobs_lock:
+            active = list(_jobs_active)
+        if active:
+            try:
+                get_db().recognition_jobs.update_many({"_id": {"$in": active}},
+                                                      {"$set": {"heartbeat_at": datetime.now()}})
+            except Exception as e:
+                print(f"Recognition job heartbeat error: {e}")
+
+
+def _start_job_heartbeat():
+    global _job_heartbeat
+    with _jobs_lock:
+        if _job_heartbeat is None:
+            _job_heartbeat = threading.Thread(target=_job_heartbeat_loop, daemon=True)
+            _job_heartbeat.start()
+
+
+def _run_recognition_job(job_id, params):
+    global _jobs_pending
+    db = get_db()
+    try:
+        db.recognition_jobs.update_one({"_id": job_id},
+                                       {"$set": {"status": "running", "started_at": datetime.now()}})
+        while True:
+            try:
+                payload, _ = mark_attendance_from_photo(**params)
+                break
+            except PoolBusy as e:
+                time.sleep(e.retry_after)  # synchronous /recognize calls hold the pool; wait our turn
+        db.recognition_jobs.update_one({"_id": job_id}, {"$set": {
+            "status":      "done" if payload.get("success") else "failed",
+            "result":      payload,
+            "error":       payload.get("error"),
+            "finished_at": datetime.now(),
+        }})
+    except Exception as e:
+        print(f"Recognition job {job_id} error: {e}")
+        db.recognition_jobs.update_one({"_id": job_id}, {"$set": {
+            "status": "failed", "error": str(e), "finished_at": datetime.now(),
+        }})
+    finally:
+        with _jobs_lock:
+            _jobs_pending -= 1
+            _jobs_active.discard(job_id)
 
-        db          = get_db()
-        today       = datetime.now().strftime("%Y-%m-%d")
-        start       = datetime.now().strftime("%H:%M")
-        end         = (datetime.now() + timedelta(hours=1)).strftime("%H:%M")
-        subj_oid    = oid(subject_id)
-        teacher_oid = oid(teacher_id)
 
-        existing = db.sessions.find_one({
-            "subject_id": subj_oid, "teacher_id": teacher_oid,
-            "date": today, "start_time": start, "end_time": end,
-        })
-        if existing:
-            session_id = existing["_id"]
-        else:
-            session_id = db.sessions.insert_one({
-                "subject_id": subj_oid, "teacher_id": teacher_oid,
-                "date": today, "start_time": start, "end_time": end,
-                "created_at": datetime.now(),
-            }).inserted_id
+def _job_retry_after():
+    with _jobs_lock:
+        backlog = _jobs_pending
+    per_job = inference_pool.stats()["avg_run_ms"] / 1000 if inference_pool else 1.0
+    return max(1, int(np.ceil(backlog * max(per_job, 0.5) / JOB_WORKERS)))
 
-        marked_students = []
-        for rec in result["recognitions"]:
-            if rec["name"] == "Unknown" or rec["confidence"] < threshold:
-                continue
-            student = db.students.find_one({"name": rec["name"]})
-            if not student:
-                new_id      = db.students.insert_one({
-                    "name": rec["name"], "roll_no": None, "department": None,
-                    "year": None, "face_count": 0, "attendance_count": 0,
-                    "created_at": datetime.now(),
-                }).inserted_id
-                student_oid = new_id
-                student_dir = DATASET_DIR / str(new_id)
-                student_dir.mkdir(parents=True, exist_ok=True)
-                (student_dir / "name.txt").write_text(rec["name"], encoding="utf-8")
-            else:
-                student_oid = student["_id"]
 
-            db.attendance.update_one(
-                {"session_id": session_id, "student_id": student_oid},
-                {"$set": {"status": "present", "confidence": rec["confidence"],
-                          "marked_at": datetime.now()}},
-                upsert=True,
-            )
-            marked_students.append(rec["name"])
-
-        for student in db.students.find():
-            db.attendance.update_one(
-                {"session_id": session_id, "student_id": student["_id"]},
-                {"$setOnInsert": {"status": "absent", "confidence": None,
-                                  "marked_at": datetime.now()}},
-                upsert=True,
-            )
+@app.route("/api/recognition_jobs", methods=["POST"])
+@login_required
+@role_required("admin", "teacher")
+def submit_recognition_job():
+    global _jobs_pending
+    if not INSIGHTFACE_AVAILABLE or not insightface_app:
+        return jsonify({"success": False, "error": "Face recognition not available"}), 500
+    with _jobs_lock:
+        full = _jobs_pending >= JOB_QUEUE
+        if not full:
+            _jobs_pending += 1
+    if full:
+        return _busy_response(_job_retry_after(), "Too many recognition jobs queued; retry shortly")
+    try:
+        params, error = _recognition_params()
+        if error:
+            with _jobs_lock:
+                _jobs_pending -= 1
+            return jsonify({"success": False, "error": error}), 400
+        _start_job_heartbeat()
+        job_id = get_db().recognition_jobs.insert_one({
+            "status":       "queued",
+            "user_id":      session.get("user_id"),
+            "photo":        params["photo"].name,
+            "subject_id":   params["subject_id"],
+            "created_at":   datetime.now(),
+            "heartbeat_at": datetime.now(),
+        }).inserted_id
+        with _jobs_lock:
+            _jobs_active.add(job_id)
+        _job_executor.submit(_run_recognition_job, job_id, params)
+    except Exception as e:
+        with _jobs_lock:
+            _jobs_pending -= 1
+        print(f"Recognition job submit error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({"success": True, "job_id": str(job_id), "status": "queued",
+                    "status_url": f"/api/recognition_jobs/{job_id}"}), 202
+
+
+@app.route("/api/recognition_jobs/<job_id>")
+@login_required
+@role_required("admin", "teacher")
+def recognition_job_status(job_id):
+    query = {"_id": oid(job_id)}
+    if session.get("user_role") != "admin":
+        query["user_id"] = session.get("user_id")   # teachers only see their own jobs
+    db  = get_db()
+    job = db.recognition_jobs.find_one(query) if oid(job_id) else None
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    beat = job.get("heartbeat_at", job["created_at"])
+    if job["status"] in ("queued", "running") and datetime.now() - beat > timedelta(seconds=JOB_STALE_SECONDS):
+        stale = {"status": "failed", "error": "The worker running this job stopped; please resubmit the photo",
+                 "finished_at": datetime.now()}
+        job = (db.recognition_jobs.find_one_and_update({"_id": job["_id"], "status": job["status"]}, {"$set": stale},
+                                                       return_document=ReturnDocument.AFTER)
+               or db.recognition_jobs.find_one({"_id": job["_id"]}))   # it finished meanwhile
+    return jsonify({
+        "success": True,
+        "job_id":  job_id,
+        "status":  job["status"],
+        "result":  job.get("result"),
+        "error":   job.get("error"),
+    })
+
+# ==================== STREAMING RECOGNITION ====================
+# A classroom camera opens a stream (POST /api/streams) and keeps posting
+# frames to it over a kept-alive connection. Faces are tracked from frame to
+# frame (tracking.py): only new tracks, or tracks whose face got clearly
+# better, are embedded and matched — the others keep their identity — and a
+# student's attendance is written the first time they are seen, or again when
+# seen more confidently. Closing the stream marks everyone else absent.
+# Streams live in this process's memory, so with several workers a stream's
+# requests must reach the same one (sticky sessions).
+# Streams idle for STREAM_IDLE_SECONDS are closed by a background sweep,
+# started with the first stream, so a tab closed without DELETE still gets
+# its absentees and timeline entry.
+_streams       = {}
+_streams_lock  = threading.Lock()
+_stream_sweep  = None
+STREAM_CONFIDENCE_STEP = 0.05   # improvement that rewrites a present record
+STREAM_SWEEP_SECONDS   = 30     # how often idle streams are looked for
+
+
+def _track_frame(analyzer, img_rgb, tracker):
+    """Detect, advance the tracker and embed, in one batch, only the tracks that need it."""
+    bboxes, kpss = analyzer.det_model.detect(img_rgb, max_num=0, metric="default")
+    tracks  = tracker.update(bboxes, kpss)
+    pending = [track for track in tracks if track.needs_embedding()]
+    results = extract_embeddings(img_rgb, [track.bbox.astype(int).tolist() for track in pending],
+                                 [track.kps for track in pending], analyzer.models["recognition"])
+    embedded, embeddings = [], []
+    for track, embedding in zip(pending, results):
+        if embedding is not None:
+            embedded.append(track)
+            embeddings.append(embedding)
+    return tracks, embedded, embeddings
 
-        subject = db.subjects.find_one({"_id": subj_oid}) or {}
-        teacher = db.users.find_one({"_id": teacher_oid}) or {}
-        append_to_timeline(latest_photo.name, len(marked_students), result["faces_found"],
-                           subject.get("subject_name", ""), teacher.get("full_name", ""))
-        update_student_statistics()
-        cleanup_old_annotated_files()
 
+def _close_stream(stream):
+    """Finish a stream's session: absentees, statistics and the timeline."""
+    db = get_db()
+    _mark_absentees(db, stream["session_id"])
+    subject = db.subjects.find_one({"_id": oid(stream["subject_id"])}) or {}
+    teacher = db.users.find_one({"_id": oid(stream["teacher_id"])}) or {}
+    append_to_timeline(f"stream_{stream['stream_id']}", len(stream["marked"]), stream["tracker"].created,
+                       subject.get("subject_name", ""), teacher.get("full_name", ""))
+
+
+def _expire_streams():
+    now = time.monotonic()
+    with _streams_lock:
+        idle = [sid for sid, s in _streams.items() if now - s["last_seen"] > STREAM_IDLE_SECONDS]
+        expired = [_streams.pop(sid) for sid in idle]
+    for stream in expired:
+        try:
+            with stream["busy"]:   # let an in-flight frame finish marking
+                _close_stream(stream)
+            print(f"⏱️ Stream {stream['stream_id']} closed after {STREAM_IDLE_SECONDS}s idle")
+        except Exception as e:
+            print(f"Stream {stream['stream_id']} expiry error: {e}")
+
+
+def _sweep_streams_loop():
+    while True:
+        time.sleep(max(1, min(STREAM_SWEEP_SECONDS, STREAM_IDLE_SECONDS)))
+        _expire_streams()
+
+
+def _start_stream_sweep():
+    global _stream_sweep
+    with _streams_lock:
+        if _stream_sweep is None:
+            _stream_sweep = threading.Thread(target=_sweep_streams_loop, daemon=True)
+            _stream_sweep.start()
+
+
+def _get_stream(stream_id):
+    with _streams_lock:
+        stream = _streams.get(stream_id)
+    if stream is None or stream["user_id"] != session.get("user_id"):
+        return None
+    return stream
+
+
+@app.route("/api/streams", methods=["POST"])
+@login_required
+@role_required("admin", "teacher")
+def open_stream():
+    if not INSIGHTFACE_AVAILABLE or not insightface_app:
+        return jsonify({"success": False, "error": "Face recognition not available"}), 500
+    subject_id = request.form.get("subject_id")
+    if not subject_id:
+        return jsonify({"success": False, "error": "Please select a subject"}), 400
+    _start_stream_sweep()
+    _expire_streams()
+    try:
+        teacher_id = request.form.get("teacher_id", session.get("user_id"))
+        stream = {
+            "stream_id":  uuid.uuid4().hex,
+            "user_id":    session.get("user_id"),
+            "subject_id": subject_id,
+            "teacher_id": teacher_id,
+            "threshold":  float(request.form.get("threshold", RECOGNITION_THRESHOLD)),
+            "session_id": _get_or_create_session(get_db(), subject_id, teacher_id),
+            "tracker":    IoUTracker(),
+            "marked":     {},   # student_id -> {"name", "confidence"}
+            "frames":     0,
+            "embedded":   0,
+            "busy":       threading.Lock(),
+            "last_seen":  time.monotonic(),
+        }
+    except Exception as e:
+        print(f"Stream open error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+    with _streams_lock:
+        _streams[stream["stream_id"]] = stream
+    return jsonify({"success": True, "stream_id": stream["stream_id"],
+                    "session_id": str(stream["session_id"]),
+                    "frames_url": f"/api/streams/{stream['stream_id']}/frames"}), 201
+
+
+@app.route("/api/streams/<stream_id>/frames", methods=["POST"])
+@login_required
+@role_required("admin", "teacher")
+def stream_frame(stream_id):
+    stream = _get_stream(stream_id)
+    if stream is None:
+        return jsonify({"success": False, "error": "Stream not found"}), 404
+    file = request.files.get("frame")
+    if not file:
+        return jsonify({"success": False, "error": "No frame"}), 400
+    # One frame per stream at a time; a client that outruns inference just drops frames
+    if not stream["busy"].acquire(blocking=False):
+        return jsonify({"success": True, "skipped": True})
+    try:
+        stream["last_seen"] = time.monotonic()
+        timings = {}
+        started = time.perf_counter()
+        try:
+            img_rgb = load_image_rgb(file.stream, DECODE_MAX_SIDE)
+        except Exception:
+            return jsonify({"success": False, "error": "Failed to read frame"}), 400
+        timings["decode"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        tracks, embedded, embeddings = inference_pool.run(_track_frame, img_rgb, stream["tracker"])
+        timings["inference"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        if embedded:
+            gallery = load_all_embeddings()
+            matches = gallery.match(np.vstack(embeddings), k=1) if gallery.size else [[]] * len(embedded)
+            for track, face_matches in zip(embedded, matches):
+                best = face_matches[0] if face_matches else None
+                if best and best["score"] >= stream["threshold"]:
+                    track.assign(best["student_id"], best["name"], best["score"])
+                else:
+                    track.assign(None, "Unknown", 0.0)
+        timings["match"] = time.perf_counter() - started
+
+        db, newly_marked = get_db(), []
+        for track in tracks:
+            if track.student_id is None:
+                continue
+            seen = stream["marked"].get(track.student_id)
+            if seen and track.confidence < seen["confidence"] + STREAM_CONFIDENCE_STEP:
+                continue
+            _mark_present(db, stream["session_id"], track.student_id, track.name, track.confidence)
+            stream["marked"][track.student_id] = {"name": track.name, "confidence": track.confidence}
+            if not seen:
+                newly_marked.append(track.name)
+
+        stream["frames"]   += 1
+        stream["embedded"] += len(embedded)
         return jsonify({
-            "success":         True,
-            "message":         f"Attendance marked for {len(marked_students)} students",
-            "faces_found":     result["faces_found"],
-            "recognized":      len(marked_students),
-            "annotated_image": result.get("annotated_image"),
-            "marked_students": marked_students,
+            "success":      True,
+            "frame":        stream["frames"],
+            "tracks":       [track.to_dict() for track in tracks],
+            "embedded":     len(embedded),
+            "newly_marked": newly_marked,
+            "present":      sorted(m["name"] for m in stream["marked"].values()),
+            "image_size":   [img_rgb.shape[1], img_rgb.shape[0]],
+            "timings":      {k: round(v * 1000, 1) for k, v in timings.items()},
         })
+    except PoolBusy as e:
+        return _busy_response(e.retry_after, str(e))
     except Exception as e:
-        print(f"Recognition error: {e}")
+        print(f"Stream frame error: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
+    finally:
+        stream["busy"].release()
+
+
+@app.route("/api/streams/<stream_id>", methods=["DELETE"])
+@login_required
+@role_required("admin", "teacher")
+def close_stream(stream_id):
+    if _get_stream(stream_id) is None:
+        return jsonify({"success": False, "error": "Stream not found"}), 404
+    with _streams_lock:
+        stream = _streams.pop(stream_id, None)
+    if stream is None:
+        return jsonify({"success": False, "error": "Stream not found"}), 404
+    try:
+        with stream["busy"]:   # let an in-flight frame finish marking
+            _close_stream(stream)
+    except Exception as e:
+        print(f"Stream close error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({
+        "success":         True,
+        "session_id":      str(stream["session_id"]),
+        "frames":          stream["frames"],
+        "faces_seen":      stream["tracker"].created,
+        "embedded":        stream["embedded"],
+        "recognized":      len(stream["marked"]),
+        "marked_students": sorted(m["name"] for m in stream["marked"].values()),
+    })
 
 # ==================== STUDENTS ====================
 
@@ -831,14 +1876,9 @@ def students():
             student_dir.mkdir(parents=True, exist_ok=True)
             (student_dir / "name.txt").write_text(name, encoding="utf-8")
 
-            if INDEX_FILE.exists():
-                with open(INDEX_FILE) as f:
-                    index = json.load(f)
-                if student_id in index:
-                    index[student_id]["name"] = name
-                    with open(INDEX_FILE, "w") as f:
-                        json.dump(index, f, indent=2)
-                    invalidate_embeddings_cache()
+            if student_id in embedding_store.students():
+                embedding_store.rename(student_id, name)
+                gallery_rename(student_id, name)
 
             return jsonify({"success": True, "message": "Student updated."})
 
@@ -857,17 +1897,7 @@ def students():
                 student_dir = DATASET_DIR / str(student_id)
                 if student_dir.exists():
                     shutil.rmtree(student_dir)
-                emb_file = ENCODINGS_DIR / f"{student_id}.npy"
-                if emb_file.exists():
-                    emb_file.unlink()
-                if INDEX_FILE.exists():
-                    with open(INDEX_FILE) as f:
-                        index = json.load(f)
-                    if student_id in index:
-                        del index[student_id]
-                        with open(INDEX_FILE, "w") as f:
-                            json.dump(index, f, indent=2)
-                invalidate_embeddings_cache()
+                delete_student_embeddings(student_id)
                 flash(f'Student "{student["name"]}" deleted.', "success")
             else:
                 flash("Student not found.", "error")
@@ -1087,15 +2117,9 @@ def create_session_page():
             "created_at": datetime.now(),
         }).inserted_id
 
-        for student in db.students.find():
-            db.attendance.update_one(
-                {"session_id": session_oid, "student_id": student["_id"]},
-                {"$setOnInsert": {"status": "absent", "confidence": None,
-                                  "marked_at": datetime.now()}},
-                upsert=True,
-            )
+        write = attendance_writer.write_session(db, session_oid, {}, attendance_writer.roster(db, subj_oid))
 
-        flash(f"Session created! (ID: {session_oid})", "success")
+        flash(f"Session created! (ID: {session_oid}, {write['roster']} students on the roster)", "success")
         return redirect(url_for("attendance", subject_id=subject_id,
                                 teacher_id=teacher_id, start_date=date, end_date=date))
 
@@ -1104,19 +2128,7 @@ def create_session_page():
     for doc in subjects + teachers:
         doc["id"] = str(doc["_id"])
 
-    recent_sessions = []
-    for s in db.sessions.find().sort("date", -1).limit(5):
-        subject = db.subjects.find_one({"_id": s["subject_id"]}) or {}
-        teacher = db.users.find_one({"_id": s["teacher_id"]}) or {}
-        present = db.attendance.count_documents({"session_id": s["_id"], "status": "present"})
-        recent_sessions.append({
-            "id":            str(s["_id"]),
-            "date":          s["date"],
-            "start_time":    s["start_time"],
-            "subject_name":  subject.get("subject_name", ""),
-            "teacher_name":  teacher.get("full_name", ""),
-            "present_count": present,
-        })
+    recent_sessions = attendance_stats.recent_sessions(db)
 
     return render_template("create_session.html",
                            subjects=subjects, teachers=teachers,
@@ -1132,8 +2144,11 @@ def reset_session(session_id):
     if not db.sessions.find_one({"_id": sid}):
         flash("Session not found.", "error")
         return redirect(url_for("attendance"))
+    present = [a["student_id"] for a in db.attendance.find({"session_id": sid, "status": "present"},
+                                                           {"student_id": 1})]
     db.attendance.update_many({"session_id": sid},
                               {"$set": {"status": "absent", "confidence": None}})
+    attendance_stats.adjust_attendance_counts(db, present, -1)
     flash(f"Session attendance reset.", "success")
     return redirect(url_for("attendance", session_id=session_id))
 
@@ -1147,8 +2162,11 @@ def delete_session(session_id):
     if not db.sessions.find_one({"_id": sid}):
         flash("Session not found.", "error")
     else:
+        present = [a["student_id"] for a in db.attendance.find({"session_id": sid, "status": "present"},
+                                                               {"student_id": 1})]
         db.sessions.delete_one({"_id": sid})
         db.attendance.delete_many({"session_id": sid})
+        attendance_stats.adjust_attendance_counts(db, present, -1)
         flash("Session deleted.", "success")
     return redirect(url_for("attendance"))
 
@@ -1162,6 +2180,11 @@ def attendance():
     teacher_id = request.args.get("teacher_id", "")
     start_date = request.args.get("start_date", (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d"))
     end_date   = request.args.get("end_date",   datetime.now().strftime("%Y-%m-%d"))
+    sort       = request.args.get("sort", "name")
+    if sort not in attendance_stats.MATRIX_SORTS:
+        sort = "name"
+    page       = request.args.get("page", 1, type=int)
+    per_page   = min(request.args.get("per_page", attendance_stats.MATRIX_PAGE_SIZE, type=int), 200)
 
     subjects = list(db.subjects.find().sort("subject_name", 1))
     teachers = list(db.users.find({"role": "teacher"}).sort("full_name", 1))
@@ -1174,69 +2197,28 @@ def attendance():
     if teacher_id:
         session_query["teacher_id"] = oid(teacher_id)
 
-    sessions_raw = list(db.sessions.find(session_query).sort([("date", -1), ("start_time", -1)]))
-    session_oids = [s["_id"] for s in sessions_raw]
-
-    sessions_list = []
-    for s in sessions_raw:
-        subject = db.subjects.find_one({"_id": s["subject_id"]}) or {}
-        teacher = db.users.find_one({"_id": s["teacher_id"]}) or {}
-        sessions_list.append({
-            "id":           str(s["_id"]),
-            "date":         s["date"],
-            "start_time":   s["start_time"],
-            "end_time":     s["end_time"],
-            "subject_name": subject.get("subject_name", ""),
-            "teacher_name": teacher.get("full_name", ""),
-        })
+    sessions_list = attendance_stats.sessions(db, session_query, sort={"date": -1, "start_time": -1})
+    session_oids  = [s.pop("_id") for s in sessions_list]
 
-    student_filter = {}
+    student_ids = None
     if session.get("user_role") == "student" and session.get("student_id"):
-        student_filter = {"_id": oid(session["student_id"])}
-
-    attendance_summary = []
-    defaulters         = []
-
-    for student in db.students.find(student_filter).sort("name", 1):
-        sid     = student["_id"]
-        att     = list(db.attendance.find({"student_id": sid, "session_id": {"$in": session_oids}}))
-        total   = len(att)
-        present = sum(1 for a in att if a["status"] == "present")
-        pct     = round(present / total * 100, 1) if total > 0 else 0
-
-        row = {
-            "id":                 str(sid),
-            "name":               student["name"],
-            "roll_no":            student.get("roll_no"),
-            "department":         student.get("department"),
-            "present_count":      present,
-            "total_sessions":     total,
-            "attendance_percent": pct,
-            "session_attendance": {str(a["session_id"]): a["status"] for a in att},
-        }
-        attendance_summary.append(row)
-        if pct < 75 and total >= 3:
-            defaulters.append(row)
-
-    recent_sessions = []
-    for s in db.sessions.find().sort("date", -1).limit(5):
-        subject = db.subjects.find_one({"_id": s["subject_id"]}) or {}
-        teacher = db.users.find_one({"_id": s["teacher_id"]}) or {}
-        present = db.attendance.count_documents({"session_id": s["_id"], "status": "present"})
-        recent_sessions.append({
-            "id":            str(s["_id"]),
-            "date":          s["date"],
-            "start_time":    s["start_time"],
-            "subject_name":  subject.get("subject_name", ""),
-            "teacher_name":  teacher.get("full_name", ""),
-            "present_count": present,
-        })
+        student_ids = [oid(session["student_id"])]
+    matrix = attendance_stats.attendance_matrix(db, session_oids, student_ids, sort, page, per_page)
+
+    recent_sessions = attendance_stats.recent_sessions(db)
 
     return render_template("attendance.html",
                            subjects=subjects, teachers=teachers,
                            sessions=sessions_list,
-                           attendance_summary=attendance_summary,
-                           defaulters=defaulters,
+                           attendance_summary=matrix["rows"],
+                           defaulters=matrix["defaulters"],
+                           student_count=matrix["student_count"],
+                           average_percent=matrix["average_percent"],
+                           page=matrix["page"], pages=matrix["pages"], per_page=matrix["per_page"],
+                           sort=sort,
+                           filter_args={"subject_id": subject_id, "teacher_id": teacher_id,
+                                        "start_date": start_date, "end_date": end_date,
+                                        "sort": sort, "per_page": matrix["per_page"]},
                            recent_sessions=recent_sessions,
                            total_sessions=len(sessions_list),
                            selected_subject_id=subject_id,
@@ -1255,9 +2237,22 @@ def reset_attendance():
     att_count     = db.attendance.count_documents({})
     db.sessions.delete_many({})
     db.attendance.delete_many({})
+    db.students.update_many({}, {"$set": {"attendance_count": 0}})
     flash(f"✅ Reset complete. Deleted {session_count} sessions and {att_count} records.", "success")
     return redirect(url_for("users_page"))
 
+
+@app.route("/admin/reconcile_statistics", methods=["POST"])
+@login_required
+@role_required("admin")
+def reconcile_statistics():
+    fixed = reconcile_student_statistics()
+    if fixed is None:
+        flash("Could not reconcile statistics; see the server log.", "error")
+    else:
+        flash(f"✅ Statistics reconciled; {fixed} students corrected.", "success")
+    return redirect(url_for("users_page"))
+
 # ==================== MANUAL ATTENDANCE ====================
 
 @app.route("/session/<session_id>/mark_manual", methods=["POST"])
@@ -1278,15 +2273,65 @@ def mark_attendance_manual(session_id):
     if not student:
         return jsonify({"success": False, "error": "Student not found"}), 404
 
-    db.attendance.update_one(
-        {"session_id": sid, "student_id": stid},
-        {"$set": {"status": "present", "confidence": None, "marked_at": datetime.now()}},
-        upsert=True,
-    )
+    _mark_present(db, sid, student_id, student["name"], None)
     return jsonify({"success": True, "message": f'Marked {student["name"]} present'})
 
 # ==================== REPORTS ====================
 
+def _csv_chunks(rows):
+    """CSV text of `rows`, yielded every CSV_FLUSH_ROWS rows so a response can stream it."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % CSV_FLUSH_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _attendance_report_rows(db, session_query):
+    """Rows of the attendance CSV, read from one cursor over the matching records.
+
+    Sessions (with subject and teacher names) and students are loaded once
+    into lookup maps; records are never held in memory, and the summary is
+    counted as they stream past.
+    """
+    sessions = {s.pop("_id"): s for s in attendance_stats.sessions(db, session_query)}
+    students = {s["_id"]: s for s in db.students.find({}, {"roll_no": 1, "name": 1, "department": 1})}
+
+    yield ["# Attendance Report"]
+    yield [f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"]
+    yield []
+    yield ["Roll No", "Student Name", "Department", "Subject", "Teacher",
+           "Date", "Start Time", "End Time", "Status", "Confidence", "Marked At"]
+
+    total = present_count = 0
+    cursor = db.attendance.find(
+        {"session_id": {"$in": list(sessions)}},
+        {"session_id": 1, "student_id": 1, "status": 1, "confidence": 1, "marked_at": 1},
+        allow_disk_use=True,
+    ).sort("marked_at", -1)
+    for att in cursor:
+        s       = sessions.get(att["session_id"], {})
+        student = students.get(att["student_id"], {})
+        total  += 1
+        if att.get("status") == "present":
+            present_count += 1
+        yield [student.get("roll_no", ""), student.get("name", ""), student.get("department", ""),
+               s.get("subject_name", ""), s.get("teacher_name", ""),
+               s.get("date", ""), s.get("start_time", ""), s.get("end_time", ""),
+               att.get("status", ""),
+               f"{att['confidence']:.2f}" if att.get("confidence") else "",
+               str(att.get("marked_at", ""))]
+
+    yield []
+    yield ["# Summary"]
+    yield ["Total", total, "Present", present_count, "Absent", total - present_count]
+
+
 @app.route("/download_attendance_report")
 @login_required
 def download_attendance_report():
@@ -1308,52 +2353,8 @@ def download_attendance_report():
         if end_date:
             session_query["date"]["$lte"] = end_date
 
-    sessions_raw = list(db.sessions.find(session_query))
-    session_oids = [s["_id"] for s in sessions_raw]
-    session_map  = {s["_id"]: s for s in sessions_raw}
-
-    rows = []
-    for att in db.attendance.find({"session_id": {"$in": session_oids}}).sort("marked_at", -1):
-        s       = session_map.get(att["session_id"], {})
-        student = db.students.find_one({"_id": att["student_id"]}) or {}
-        subject = db.subjects.find_one({"_id": s.get("subject_id")}) or {}
-        teacher = db.users.find_one({"_id": s.get("teacher_id")}) or {}
-        rows.append({
-            "roll_no":    student.get("roll_no", ""),
-            "name":       student.get("name", ""),
-            "department": student.get("department", ""),
-            "subject":    subject.get("subject_name", ""),
-            "teacher":    teacher.get("full_name", ""),
-            "date":       s.get("date", ""),
-            "start_time": s.get("start_time", ""),
-            "end_time":   s.get("end_time", ""),
-            "status":     att.get("status", ""),
-            "confidence": att.get("confidence"),
-            "marked_at":  str(att.get("marked_at", "")),
-        })
-
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["# Attendance Report"])
-    writer.writerow([f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"])
-    writer.writerow([])
-    writer.writerow(["Roll No", "Student Name", "Department", "Subject", "Teacher",
-                     "Date", "Start Time", "End Time", "Status", "Confidence", "Marked At"])
-    present_count = 0
-    for row in rows:
-        if row["status"] == "present":
-            present_count += 1
-        writer.writerow([row["roll_no"], row["name"], row["department"], row["subject"],
-                         row["teacher"], row["date"], row["start_time"], row["end_time"],
-                         row["status"],
-                         f"{row['confidence']:.2f}" if row["confidence"] else "",
-                         row["marked_at"]])
-    writer.writerow([])
-    writer.writerow(["# Summary"])
-    writer.writerow(["Total", len(rows), "Present", present_count, "Absent", len(rows) - present_count])
-
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    return Response(output.getvalue(), mimetype="text/csv",
+    return Response(_csv_chunks(_attendance_report_rows(db, session_query)), mimetype="text/csv",
                     headers={"Content-Disposition": f"attachment; filename=attendance_{ts}.csv"})
 
 
@@ -1383,25 +2384,8 @@ def export_defaulters():
     if teacher_id:
         session_query["teacher_id"] = oid(teacher_id)
 
-    session_oids = [s["_id"] for s in db.sessions.find(session_query)]
-
-    defaulters = []
-    for student in db.students.find():
-        att   = list(db.attendance.find({"student_id": student["_id"], "session_id": {"$in": session_oids}}))
-        total = len(att)
-        if total < 3:
-            continue
-        present = sum(1 for a in att if a["status"] == "present")
-        pct     = round(present / total * 100, 1)
-        if pct < 75:
-            defaulters.append({
-                "name":       student["name"],
-                "roll_no":    student.get("roll_no", ""),
-                "department": student.get("department", ""),
-                "present":    present,
-                "total":      total,
-                "percent":    pct,
-            })
+    session_oids = [s["_id"] for s in db.sessions.find(session_query, {"_id": 1})]
+    defaulters   = attendance_stats.attendance_matrix(db, session_oids, per_page=1)["defaulters"]
 
     output = io.StringIO()
     writer = csv.writer(output)
@@ -1411,7 +2395,7 @@ def export_defaulters():
     writer.writerow(["Name", "Roll No", "Department", "Present", "Total Sessions", "Attendance %"])
     for d in defaulters:
         writer.writerow([d["name"], d["roll_no"], d["department"],
-                         d["present"], d["total"], f"{d['percent']}%"])
+                         d["present_count"], d["total_sessions"], f"{d['attendance_percent']}%"])
     writer.writerow([])
     writer.writerow(["Total Defaulters:", len(defaulters)])
 
@@ -1447,12 +2431,10 @@ def encode_status():
         progress_copy = dict(_encoding_progress)
     total_students   = len([d for d in DATASET_DIR.iterdir() if d.is_dir()]) if DATASET_DIR.exists() else 0
     encoded_students = 0
-    if INDEX_FILE.exists():
-        try:
-            with open(INDEX_FILE) as f:
-                encoded_students = len(json.load(f))
-        except Exception:
-            pass
+    try:
+        encoded_students = len(embedding_store.students())
+    except Exception:
+        pass
     progress_copy["total_students"]   = total_students
     progress_copy["encoded_students"] = encoded_students
     return jsonify(progress_copy)
@@ -1466,7 +2448,9 @@ def health_check():
         "insightface": INSIGHTFACE_AVAILABLE and insightface_app is not None,
         "directories": all(d.exists() for d in [DATASET_DIR, ENCODINGS_DIR, UPLOADS_DIR]),
     }
-    return jsonify({"status": "healthy" if all(checks.values()) else "unhealthy", "checks": checks})
+    return jsonify({"status": "healthy" if all(checks.values()) else "unhealthy", "checks": checks,
+                    "insightface": insightface_stats,
+                    "inference":   inference_pool.stats() if inference_pool else None})
 
 
 @app.route("/api/students")
@@ -1482,17 +2466,8 @@ def api_students():
 @app.route("/api/dashboard_stats")
 @login_required
 def dashboard_stats():
-    db    = get_db()
     today = datetime.now().strftime("%Y-%m-%d")
-    today_sids = [s["_id"] for s in db.sessions.find({"date": today})]
-    return jsonify({"success": True, "stats": {
-        "total_students":   db.students.count_documents({}),
-        "today_sessions":   len(today_sids),
-        "today_attendance": db.attendance.count_documents(
-            {"session_id": {"$in": today_sids}, "status": "present"}
-        ) if today_sids else 0,
-        "total_attendance": db.attendance.count_documents({"status": "present"}),
-    }})
+    return jsonify({"success": True, "stats": attendance_stats.totals(get_db(), today)})
 
 
 @app.route("/api/capture_statistics")
@@ -1503,7 +2478,7 @@ def capture_statistics():
         "total_faces":      0,
         "today_captures":   0,
         "storage_used":     "0 bytes",
-        "encodings_ready":  INDEX_FILE.exists() and INDEX_FILE.stat().st_size > 0,
+        "encodings_ready":  bool(embedding_store.students()),
         "recognition_ready": INSIGHTFACE_AVAILABLE and insightface_app is not None,
     })
 
@@ -1512,28 +2487,44 @@ def capture_statistics():
 @login_required
 @role_required("admin", "teacher")
 def recent_captures():
+    """The newest uploaded photos and recognition results, annotated ones drawn on demand."""
     try:
-        image_files = []
-        for ext in ["*.jpg", "*.jpeg", "*.png"]:
-            image_files.extend(UPLOADS_DIR.glob(ext))
-        image_files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
+        files = [f for ext in ["*.jpg", "*.jpeg", "*.png"] for f in UPLOADS_DIR.glob(ext)]
+        files += list(RESULTS_DIR.glob("*.json"))
+        files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
 
         recent = []
-        for file in image_files[:12]:
-            stat       = file.stat()
-            thumb_name = f"thumb_{file.name}"
-            if not (THUMB_DIR / thumb_name).exists():
-                save_thumbnail(file)
-            recent.append({
-                "id":        file.name,
-                "filename":  file.name,
-                "url":       f"/uploads/{file.name}",
-                "thumbnail": f"/uploads/thumbs/{thumb_name}",
-                "timestamp": datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M"),
-                "time":      humanize.naturaltime(datetime.fromtimestamp(stat.st_mtime)) if HUMANIZE_AVAILABLE else datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M"),
-                "size":      humanize.naturalsize(stat.st_size) if HUMANIZE_AVAILABLE else f"{stat.st_size} bytes",
-                "type":      "annotated" if file.name.startswith("annotated_") else "class",
-            })
+        for file in files[:12]:
+            stat = file.stat()
+            when = datetime.fromtimestamp(stat.st_mtime)
+            entry = {
+                "timestamp": when.strftime("%Y-%m-%d %H:%M"),
+                "time":      humanize.naturaltime(when) if HUMANIZE_AVAILABLE else when.strftime("%Y-%m-%d %H:%M"),
+            }
+            if file.suffix == ".json":
+                record = load_recognition_result(file.stem) or {}
+                urls   = result_urls(file.stem)
+                entry.update({
+                    "id":        file.stem,
+                    "filename":  f"annotated_{file.stem}.jpg",
+                    "url":       urls["annotated_url"],
+                    "thumbnail": urls["thumbnail_url"],
+                    "size":      f"{len(record.get('recognitions', []))} faces",
+                    "type":      "annotated",
+                })
+            else:
+                thumb_name = f"thumb_{file.name}"
+                if not (THUMB_DIR / thumb_name).exists():
+                    save_thumbnail(file)
+                entry.update({
+                    "id":        file.name,
+                    "filename":  file.name,
+                    "url":       f"/uploads/{file.name}",
+                    "thumbnail": f"/uploads/thumbs/{thumb_name}",
+                    "size":      humanize.naturalsize(stat.st_size) if HUMANIZE_AVAILABLE else f"{stat.st_size} bytes",
+                    "type":      "class",
+                })
+            recent.append(entry)
         return jsonify({"success": True, "captures": recent})
     except Exception as e:
         return jsonify({"success": False, "error": str(e), "captures": []})
@@ -1544,6 +2535,10 @@ def recent_captures():
 @role_required("admin", "teacher")
 def delete_capture(filename):
     try:
+        record = _result_file(filename)
+        if record is not None:
+            delete_recognition_result(record)
+            return jsonify({"success": True})
         safe = secure_filename(filename)
         fp   = UPLOADS_DIR / safe
         if fp.exists():
@@ -1590,7 +2585,8 @@ def upload_student_faces():
 
 @app.route("/api/insightface_status")
 def insightface_status():
-    return jsonify({"available": INSIGHTFACE_AVAILABLE and insightface_app is not None})
+    return jsonify({"available": INSIGHTFACE_AVAILABLE and insightface_app is not None, **insightface_stats,
+                    "inference": inference_pool.stats() if inference_pool else None})
 
 # ==================== ERROR HANDLERS ====================
 
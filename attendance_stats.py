@@ -0,0 +1,232 @@
+# attendance_stats.py — dashboard and attendance-page statistics
+#
+# Every figure here comes from a fixed handful of aggregation queries,
+# whatever the number of students or sessions: counts are grouped inside
+# MongoDB ($group) and subject / teacher / student names are joined there
+# ($lookup), instead of one count_documents or find_one per student or per
+# session from Python.
+#
+# The per-student counters shown on the students page (attendance_count,
+# face_count) are kept up to date by the writes that change them;
+# `reconcile_counters` recomputes them all to repair any drift.
+import math
+from collections import Counter
+
+from pymongo import UpdateOne
+
+RECENT_SESSIONS        = 5
+TOP_STUDENTS           = 5
+DEFAULTER_RATE         = 0.75   # below this share of sessions attended…
+DEFAULTER_MIN_SESSIONS = 3      # …over at least this many sessions
+MATRIX_PAGE_SIZE       = 50
+
+# Orders of the /attendance matrix; ties are broken by name
+MATRIX_SORTS = {
+    "name":        {"student.name": 1},
+    "name_desc":   {"student.name": -1},
+    "percent":     {"rate": -1, "student.name": 1},
+    "percent_asc": {"rate": 1, "student.name": 1},
+    "defaulter":   {"defaulter": -1, "rate": 1, "student.name": 1},
+}
+
+
+def _present_expr():
+    return {"$cond": [{"$eq": ["$status", "present"]}, 1, 0]}
+
+
+def totals(db, today):
+    """Student, today's session and present-mark counts for the dashboard cards."""
+    today_ids = [s["_id"] for s in db.sessions.find({"date": today}, {"_id": 1})]
+    counts    = next(db.attendance.aggregate([
+        {"$match": {"status": "present"}},
+        {"$group": {"_id": None,
+                    "total": {"$sum": 1},
+                    "today": {"$sum": {"$cond": [{"$in": ["$session_id", today_ids]}, 1, 0]}}}},
+    ]), {"total": 0, "today": 0})
+    return {
+        "total_students":   db.students.count_documents({}),
+        "today_sessions":   len(today_ids),
+        "today_attendance": counts["today"],
+        "total_attendance": counts["total"],
+    }
+
+
+def present_counts(db, session_ids):
+    """``{session_id: present count}`` for the given sessions, in one query."""
+    return {row["_id"]: row["present"] for row in db.attendance.aggregate([
+        {"$match": {"session_id": {"$in": list(session_ids)}, "status": "present"}},
+        {"$group": {"_id": "$session_id", "present": {"$sum": 1}}},
+    ])}
+
+
+def sessions(db, query, sort=None, limit=0):
+    """Sessions matching `query` with their subject and teacher names joined in."""
+    pipeline = [{"$match": query}]
+    if sort:
+        pipeline.append({"$sort": sort})
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline += [
+        {"$lookup": {"from": "subjects", "localField": "subject_id", "foreignField": "_id", "as": "subject"}},
+        {"$lookup": {"from": "users",    "localField": "teacher_id", "foreignField": "_id", "as": "teacher"}},
+    ]
+    rows = []
+    for s in db.sessions.aggregate(pipeline):
+        rows.append({
+            "id":           str(s["_id"]),
+            "_id":          s["_id"],
+            "date":         s["date"],
+            "start_time":   s["start_time"],
+            "end_time":     s["end_time"],
+            "subject_name": s["subject"][0].get("subject_name", "") if s["subject"] else "",
+            "teacher_name": s["teacher"][0].get("full_name", "") if s["teacher"] else "",
+        })
+    return rows
+
+
+def recent_sessions(db, limit=RECENT_SESSIONS):
+    """The latest sessions with names and present counts (three queries)."""
+    rows    = sessions(db, {}, sort={"date": -1}, limit=limit)
+    present = present_counts(db, [r["_id"] for r in rows])
+    for row in rows:
+        row["present_count"] = present.get(row.pop("_id"), 0)
+    return rows
+
+
+def top_students(db, limit=TOP_STUDENTS):
+    """Students with the best attendance rate over all their sessions.
+
+    Records of deleted students are dropped by the join before ranking, so
+    they never take one of the `limit` places.
+    """
+    rows = db.attendance.aggregate([
+        {"$group": {"_id": "$student_id", "total": {"$sum": 1}, "present": {"$sum": _present_expr()}}},
+        {"$lookup": {"from": "students", "localField": "_id", "foreignField": "_id", "as": "student"}},
+        {"$unwind": "$student"},
+        {"$addFields": {"rate": {"$divide": ["$present", "$total"]}}},
+        {"$sort": {"rate": -1, "_id": 1}},
+        {"$limit": limit},
+    ])
+    return [{
+        "name":          row["student"]["name"],
+        "department":    row["student"].get("department"),
+        "present_count": row["present"],
+        "total_count":   row["total"],
+        "percentage":    round(row["present"] / row["total"] * 100, 1),
+    } for row in rows]
+
+
+def _matrix_row(row):
+    return {
+        "id":                 str(row["_id"]),
+        "name":               row["student"]["name"],
+        "roll_no":            row["student"].get("roll_no"),
+        "department":         row["student"].get("department"),
+        "present_count":      row["present"],
+        "total_sessions":     row["total"],
+        "attendance_percent": round(row["rate"] * 100, 1),
+        "session_attendance": {str(mark["session_id"]): mark["status"] for mark in row.get("marks", [])},
+    }
+
+
+def attendance_matrix(db, session_ids, student_ids=None, sort="name", page=1, per_page=MATRIX_PAGE_SIZE):
+    """One page of the student × session matrix, in a single aggregation.
+
+    Every student (or those in `student_ids`) is left-joined to their
+    attendance over `session_ids` (present, total, status per session), so
+    students with no record count at 0%; a $facet then returns the
+    requested page in `sort` order together with the figures that cover
+    every student: their count, average rate and the defaulters.
+    """
+    match = {} if student_ids is None else {"_id": {"$in": list(student_ids)}}
+    per_page = max(1, per_page)
+    page     = max(1, page)
+    result   = next(db.students.aggregate([
+        {"$match": match},
+        {"$lookup": {"from": "attendance", "let": {"student_id": "$_id"}, "as": "marks",
+                     "pipeline": [
+                         {"$match": {"$expr": {"$eq": ["$student_id", "$$student_id"]},
+                                     "session_id": {"$in": list(session_ids)}}},
+                         {"$project": {"_id": 0, "session_id": 1, "status": 1}},
+                     ]}},
+        {"$project": {"student": {"name": "$name", "roll_no": "$roll_no", "department": "$department"},
+                      "marks":   1,
+                      "total":   {"$size": "$marks"},
+                      "present": {"$size": {"$filter": {"input": "$marks",
+                                                        "cond":  {"$eq": ["$$this.status", "present"]}}}}}},
+        {"$addFields": {"rate": {"$cond": [{"$gt": ["$total", 0]}, {"$divide": ["$present", "$total"]}, 0]}}},
+        {"$addFields": {"defaulter": {"$and": [{"$lt": ["$rate", DEFAULTER_RATE]},
+                                               {"$gte": ["$total", DEFAULTER_MIN_SESSIONS]}]}}},
+        {"$facet": {
+            "summary":    [{"$group": {"_id": None, "students": {"$sum": 1}, "rate": {"$avg": "$rate"}}}],
+            "rows":       [{"$sort": MATRIX_SORTS.get(sort, MATRIX_SORTS["name"])},
+                           {"$skip": (page - 1) * per_page},
+                           {"$limit": per_page}],
+            "defaulters": [{"$match": {"defaulter": True}},
+                           {"$sort": MATRIX_SORTS["percent_asc"]},
+                           {"$project": {"marks": 0}}],
+        }},
+    ], allowDiskUse=True))
+    summary  = result["summary"][0] if result["summary"] else {"students": 0, "rate": None}
+    students = summary["students"]
+    pages    = max(1, math.ceil(students / per_page))
+    if page > pages:
+        return attendance_matrix(db, session_ids, student_ids, sort, pages, per_page)
+    return {
+        "rows":            [_matrix_row(row) for row in result["rows"]],
+        "defaulters":      [_matrix_row(row) for row in result["defaulters"]],
+        "student_count":   students,
+        "average_percent": round(summary["rate"] * 100, 1) if students else None,
+        "page":            page,
+        "pages":           pages,
+        "per_page":        per_page,
+    }
+
+
+def dashboard(db, today):
+    """Everything the dashboard shows: totals, top students and recent sessions."""
+    return {
+        "stats":           totals(db, today),
+        "top_students":    top_students(db),
+        "recent_sessions": recent_sessions(db),
+    }
+
+
+def adjust_attendance_counts(db, student_ids, delta):
+    """``$inc`` each student's attendance_count by `delta` per occurrence in `student_ids`."""
+    counts = Counter(sid for sid in student_ids if sid is not None)
+    if counts:
+        db.students.bulk_write([UpdateOne({"_id": sid}, {"$inc": {"attendance_count": n * delta}})
+                                for sid, n in counts.items()], ordered=False)
+
+
+def set_face_counts(db, face_counts):
+    """Record ``{student ObjectId: embedding rows}`` as each student's face_count."""
+    updates = [UpdateOne({"_id": sid}, {"$set": {"face_count": n}})
+               for sid, n in face_counts.items() if sid is not None]
+    if updates:
+        db.students.bulk_write(updates, ordered=False)
+
+
+def reconcile_counters(db, face_counts):
+    """Recompute attendance_count (one $group) and face_count; returns students corrected.
+
+    `face_counts` maps student id strings to their stored embedding rows;
+    students absent from it keep their face_count. Only students whose
+    counters drifted are written.
+    """
+    present = {row["_id"]: row["present"] for row in db.attendance.aggregate([
+        {"$match": {"status": "present"}},
+        {"$group": {"_id": "$student_id", "present": {"$sum": 1}}},
+    ])}
+    fixes = []
+    for student in db.students.find({}, {"attendance_count": 1, "face_count": 1}):
+        expected = {"attendance_count": present.get(student["_id"], 0)}
+        if str(student["_id"]) in face_counts:
+            expected["face_count"] = face_counts[str(student["_id"])]
+        drift = {k: v for k, v in expected.items() if student.get(k) != v}
+        if drift:
+            fixes.append(UpdateOne({"_id": student["_id"]}, {"$set": drift}))
+    if fixes:
+        db.students.bulk_write(fixes, ordered=False)
+    return len(fixes)
@@ -0,0 +1,79 @@
+# attendance_writer.py — bulk writes of a session's attendance
+#
+# A session's present marks and its "absent" seed rows are written with
+# unordered bulk_write batches: one round-trip per BULK_BATCH records instead
+# of one update_one per student. Absent rows are only seeded for the
+# session's roster and only for students who have no record in the session
+# yet. The roster is every student for subjects of the catch-all "General"
+# department; otherwise it is the students of the subject's department
+# (matched case-insensitively) plus every student with no department
+# recorded — and every student when nobody is in that department, since a
+# free-text department that matches no one says nothing about enrolment.
+import re
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from attendance_stats import adjust_attendance_counts
+
+BULK_BATCH      = 1000
+ALL_DEPARTMENTS = ("", "General")   # subject departments whose roster is every student
+
+
+def roster_query(db, subject):
+    """``students`` filter for the students a subject's sessions concern."""
+    department = ((subject or {}).get("department") or "").strip()
+    if department in ALL_DEPARTMENTS:
+        return {}
+    same = re.compile(f"^{re.escape(department)}$", re.IGNORECASE)
+    if db.students.find_one({"department": same}, {"_id": 1}) is None:
+        return {}
+    return {"department": {"$in": [same, None, ""]}}
+
+
+def roster(db, subject_id):
+    """ObjectIds of the students on the subject's roster."""
+    subject = db.subjects.find_one({"_id": subject_id}, {"department": 1}) if subject_id else None
+    return [s["_id"] for s in db.students.find(roster_query(db, subject), {"_id": 1})]
+
+
+def write_session(db, session_id, present, roster_ids, batch_size=BULK_BATCH):
+    """Mark `present` (``{student ObjectId: confidence}``) and seed absentees from `roster_ids`.
+
+    Present marks overwrite the record; absentees are only inserted where
+    the session has no record for the student, so an earlier present mark
+    is never undone. attendance_count is incremented for students who were
+    not present before (concurrent writers to one session may over-count;
+    the reconcile job repairs that). Returns counts and the time taken.
+    """
+    started  = time.perf_counter()
+    existing = {row["student_id"]: row.get("status")
+                for row in db.attendance.find({"session_id": session_id}, {"student_id": 1, "status": 1})}
+    now = datetime.now()
+
+    ops = [UpdateOne({"session_id": session_id, "student_id": sid},
+                     {"$set": {"status": "present", "confidence": confidence, "marked_at": now}},
+                     upsert=True)
+           for sid, confidence in present.items()]
+    absent = [sid for sid in roster_ids if sid not in existing and sid not in present]
+    ops += [UpdateOne({"session_id": session_id, "student_id": sid},
+                      {"$setOnInsert": {"status": "absent", "confidence": None, "marked_at": now}},
+                      upsert=True)
+            for sid in absent]
+
+    batches = 0
+    for start in range(0, len(ops), batch_size):
+        db.attendance.bulk_write(ops[start:start + batch_size], ordered=False)
+        batches += 1
+
+    newly_present = [sid for sid in present if existing.get(sid) != "present"]
+    adjust_attendance_counts(db, newly_present, 1)
+    return {
+        "roster":        len(roster_ids),
+        "present":       len(present),
+        "newly_present": len(newly_present),
+        "absent_added":  len(absent),
+        "batches":       batches,
+        "ms":            round((time.perf_counter() - started) * 1000, 1),
+    }
@@ -0,0 +1,223 @@
+# benchmark.py — offline benchmarks for the face-matching engine
+#
+# Usage:
+#   python benchmark.py ann   [--students 20000] [--templates 5] [--faces 60]
+#   python benchmark.py quant [--students 20000] [--templates 5] [--threshold 0.5]
+#   python benchmark.py decode PHOTO [--max-side 1280]
+#   python benchmark.py embed [--faces 64] [--batch-sizes 1 8 32 64] [--model buffalo_l]
+#
+# Uses a synthetic gallery (one identity vector per student plus noisy
+# templates) unless --real is given, in which case the encoded gallery under
+# encodings/ is used and queries are perturbed copies of its own rows.
+import argparse
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from gallery import Gallery, EMBEDDING_DIM, QUANTIZATION_MODES, l2_normalize
+from ann_index import IVFIndex, default_nlist
+
+
+def synthetic_gallery(students, templates, noise=0.6, seed=0):
+    rng        = np.random.default_rng(seed)
+    identities = l2_normalize(rng.standard_normal((students, EMBEDDING_DIM)))
+    entries    = []
+    for i, identity in enumerate(identities):
+        rows = identity + noise * l2_normalize(rng.standard_normal((templates, EMBEDDING_DIM)))
+        entries.append((f"s{i}", f"Student {i}", rows))
+    return entries, identities
+
+
+def synthetic_queries(identities, faces, noise=0.6, seed=1):
+    rng     = np.random.default_rng(seed)
+    targets = rng.choice(identities.shape[0], faces, replace=False)
+    queries = identities[targets] + noise * l2_normalize(rng.standard_normal((faces, EMBEDDING_DIM)))
+    return queries.astype(np.float32), [f"s{t}" for t in targets]
+
+
+def real_gallery():
+    import app
+    gallery = app.load_all_embeddings()
+    entries = []
+    for sid, name, start, count in zip(gallery.student_ids, gallery.names, gallery.offsets, gallery.counts):
+        entries.append((sid, name, gallery.matrix[start:start + count]))
+    return entries
+
+
+def timed_match(gallery, queries, k, repeats):
+    gallery.match(queries, k=k)  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = gallery.match(queries, k=k)
+    return result, (time.perf_counter() - start) / repeats * 1000
+
+
+def bench_ann(args):
+    if args.real:
+        entries = real_gallery()
+        rng     = np.random.default_rng(1)
+        picks   = rng.choice(len(entries), min(args.faces, len(entries)), replace=False)
+        queries = np.vstack([entries[p][2][0] for p in picks])
+        queries = queries + 0.3 * l2_normalize(rng.standard_normal(queries.shape))
+    else:
+        entries, identities = synthetic_gallery(args.students, args.templates)
+        queries, _ = synthetic_queries(identities, args.faces)
+
+    exact = Gallery.from_students(entries)
+    print(f"Gallery: {exact.student_count} students, {exact.size} rows, "
+          f"{exact.matrix.nbytes / 1e6:.1f} MB")
+
+    truth, exact_ms = timed_match(exact, queries, args.k, args.repeats)
+    truth_ids = [[c["student_id"] for c in row] for row in truth]
+    print(f"exact           {exact_ms:9.2f} ms/photo  recall@1 1.000")
+
+    nlist = args.nlist or default_nlist(exact.size)
+    start = time.perf_counter()
+    index = IVFIndex.train(exact.matrix, nlist=nlist)
+    print(f"IVF train ({index.nlist} cells): {time.perf_counter() - start:.2f} s")
+
+    for nprobe in args.nprobe:
+        approx = Gallery.from_students(entries)
+        approx.attach_index(index, nprobe)
+        result, ms = timed_match(approx, queries, args.k, args.repeats)
+        top1   = np.mean([bool(r) and r[0]["student_id"] == t[0] for r, t in zip(result, truth_ids)])
+        topk   = np.mean([len(set(c["student_id"] for c in r) & set(t)) / len(t)
+                          for r, t in zip(result, truth_ids)])
+        print(f"ivf nprobe={nprobe:<4d} {ms:9.2f} ms/photo  recall@1 {top1:.3f}  "
+              f"recall@{args.k} {topk:.3f}  speed-up {exact_ms / ms:5.1f}x")
+
+
+def decisions(result, threshold):
+    return [r[0]["student_id"] if r and r[0]["score"] >= threshold else None for r in result]
+
+
+def bench_quant(args):
+    entries, identities = synthetic_gallery(args.students, args.templates)
+    genuine, _  = synthetic_queries(identities, args.faces, noise=args.noise)
+    rng         = np.random.default_rng(2)
+    impostors   = l2_normalize(rng.standard_normal((args.faces, EMBEDDING_DIM)))
+    queries     = np.vstack([genuine, impostors]).astype(np.float32)
+    print(f"Gallery: {args.students} students × {args.templates} templates, "
+          f"{len(queries)} faces per photo ({args.faces} enrolled, {args.faces} unknown), "
+          f"threshold {args.threshold}")
+
+    baseline = None
+    for mode in QUANTIZATION_MODES:
+        gallery = Gallery.from_students(entries, quantization=mode, rescore=args.rescore)
+        result, ms = timed_match(gallery, queries, args.k, args.repeats)
+        top1 = np.array([r[0]["score"] if r else 0.0 for r in result])
+        made = decisions(result, args.threshold)
+        if baseline is None:
+            baseline = (top1, made, ms)
+            print(f"{mode:5s} scan {gallery.scan_bytes / 1e6:7.1f} MB  resident {gallery.resident_bytes / 1e6:7.1f} MB  "
+                  f"{ms:9.2f} ms/photo  (reference)")
+            continue
+        agree = np.mean([a == b for a, b in zip(made, baseline[1])])
+        delta = np.max(np.abs(top1 - baseline[0]))
+        print(f"{mode:5s} scan {gallery.scan_bytes / 1e6:7.1f} MB  resident {gallery.resident_bytes / 1e6:7.1f} MB  "
+              f"{ms:9.2f} ms/photo  "
+              f"decisions agree {agree:.3f}  max |Δscore| {delta:.2e}  speed-up {baseline[2] / ms:4.1f}x")
+
+
+def decode_legacy(path):
+    """The pre-pipeline path: full decode, RGB→BGR, BGR→RGB, canvas copy."""
+    import cv2
+    from PIL import Image, ImageOps
+    img_bgr = cv2.cvtColor(np.array(ImageOps.exif_transpose(Image.open(str(path)))), cv2.COLOR_RGB2BGR)
+    img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+    return img_rgb, img_bgr.copy()
+
+
+def decode_pipeline(path, max_side, annotate):
+    import cv2
+    from imaging import load_image_rgb
+    img_rgb = load_image_rgb(path, max_side)
+    return img_rgb, cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR) if annotate else None
+
+
+def bench_decode(args):
+    variants = [
+        ("legacy",                  lambda: decode_legacy(args.photo)),
+        ("decode-once",             lambda: decode_pipeline(args.photo, 0, True)),
+        ("decode-once, no canvas",  lambda: decode_pipeline(args.photo, 0, False)),
+        (f"max side {args.max_side}", lambda: decode_pipeline(args.photo, args.max_side, True)),
+    ]
+    for label, run in variants:
+        img, _ = run()  # warm-up (imports, file cache)
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            run()
+        ms = (time.perf_counter() - start) / args.repeats * 1000
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:24s} {img.shape[1]:5d}×{img.shape[0]:<5d} {ms:8.1f} ms  peak {peak / 1e6:7.1f} MB")
+
+
+def bench_embed(args):
+    from insightface.model_zoo import get_model
+    from insightface.utils import ensure_available
+    from face_embedding import CROP_SIZE, embed_crops
+    model_dir = ensure_available("models", args.model)
+    rec_path  = next(os.path.join(model_dir, f) for f in sorted(os.listdir(model_dir))
+                     if f.endswith(".onnx") and get_model(os.path.join(model_dir, f)).taskname == "recognition")
+    model = get_model(rec_path, providers=["CPUExecutionProvider"])
+    model.prepare(ctx_id=-1)
+    rng   = np.random.default_rng(0)
+    crops = [rng.integers(0, 256, (CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8) for _ in range(args.faces)]
+    for batch_size in args.batch_sizes:
+        embed_crops(model, crops[:batch_size], batch_size)  # warm-up (session arenas for this shape)
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            embed_crops(model, crops, batch_size)
+        seconds = (time.perf_counter() - start) / args.repeats
+        print(f"batch {batch_size:4d}  {seconds * 1000:8.1f} ms/{args.faces} faces  {args.faces / seconds:8.1f} faces/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Face-matching benchmarks")
+    sub    = parser.add_subparsers(dest="command", required=True)
+
+    ann = sub.add_parser("ann", help="IVF recall vs latency against exact search")
+    ann.add_argument("--students",  type=int, default=20000)
+    ann.add_argument("--templates", type=int, default=5)
+    ann.add_argument("--faces",     type=int, default=60, help="faces per simulated class photo")
+    ann.add_argument("--k",         type=int, default=3)
+    ann.add_argument("--nlist",     type=int, default=None)
+    ann.add_argument("--nprobe",    type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    ann.add_argument("--repeats",   type=int, default=5)
+    ann.add_argument("--real",      action="store_true", help="use the gallery in encodings/")
+    ann.set_defaults(func=bench_ann)
+
+    quant = sub.add_parser("quant", help="int8 first pass vs float32: memory, latency, decisions")
+    quant.add_argument("--students",  type=int, default=20000)
+    quant.add_argument("--templates", type=int, default=5)
+    quant.add_argument("--faces",     type=int, default=30, help="enrolled (and as many unknown) faces per photo")
+    quant.add_argument("--noise",     type=float, default=1.0, help="query noise; higher = scores nearer the threshold")
+    quant.add_argument("--k",         type=int, default=3)
+    quant.add_argument("--rescore",   type=int, default=10)
+    quant.add_argument("--threshold", type=float, default=float(os.environ.get("RECOGNITION_THRESHOLD", 0.5)))
+    quant.add_argument("--repeats",   type=int, default=5)
+    quant.set_defaults(func=bench_quant)
+
+    decode = sub.add_parser("decode", help="photo decode time and peak memory per recognition request")
+    decode.add_argument("photo")
+    decode.add_argument("--max-side", type=int, default=1280)
+    decode.add_argument("--repeats",  type=int, default=5)
+    decode.set_defaults(func=bench_decode)
+
+    embed = sub.add_parser("embed", help="recognition-model throughput per embedding batch size")
+    embed.add_argument("--faces",       type=int, default=64)
+    embed.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    embed.add_argument("--model",       default=os.environ.get("INSIGHTFACE_MODEL", "buffalo_l"))
+    embed.add_argument("--repeats",     type=int, default=5)
+    embed.set_defaults(func=bench_embed)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
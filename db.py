@@ -47,6 +47,9 @@ def init_indexes():
     db.attendance.create_index("student_id")
     db.attendance.create_index("session_id")
 
+    # recognition jobs — polled by id, dropped a day after submission
+    db.recognition_jobs.create_index("created_at", expireAfterSeconds=86400)
+
     print("✅ MongoDB indexes created")
 
 
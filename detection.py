@@ -0,0 +1,84 @@
+# detection.py — tiled multi-scale face detection for large photos
+#
+# The detector sees every image resized to its fixed input (det_size), so in
+# a 4000×3000 lecture-hall photo the back rows shrink below what it can find.
+# Here the full image is detected once at that scale (large, near faces) and
+# then again in overlapping tiles at close to native resolution (small, far
+# faces). Faces cut by an inner tile edge are dropped — the overlapping
+# neighbour sees them whole — and the rest are merged with NMS.
+import numpy as np
+
+DEFAULT_OVERLAP = 0.25
+DEFAULT_IOU     = 0.4
+EDGE_MARGIN     = 4   # px from an inner tile edge that counts as cut
+
+
+def tile_starts(size, tile, step):
+    """Tile origins along one axis; the last tile is flush with the far edge."""
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile + 1, step))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+def tile_grid(height, width, tile, overlap=DEFAULT_OVERLAP):
+    """``(y0, x0, y1, x1)`` of overlapping `tile`-sized windows covering the image."""
+    step = max(1, int(tile * (1 - overlap)))
+    return [(y0, x0, min(y0 + tile, height), min(x0 + tile, width))
+            for y0 in tile_starts(height, tile, step)
+            for x0 in tile_starts(width, tile, step)]
+
+
+def nms(boxes, scores, iou=DEFAULT_IOU):
+    """Indices of the boxes kept by greedy non-maximum suppression, best first."""
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = np.argsort(-scores)
+    keep  = []
+    while order.size:
+        best = order[0]
+        keep.append(best)
+        w = np.maximum(0.0, np.minimum(x2[best], x2[order[1:]]) - np.maximum(x1[best], x1[order[1:]]) + 1)
+        h = np.maximum(0.0, np.minimum(y2[best], y2[order[1:]]) - np.maximum(y1[best], y1[order[1:]]) + 1)
+        overlap = w * h / (areas[best] + areas[order[1:]] - w * h)
+        order   = order[1:][overlap <= iou]
+    return np.array(keep, dtype=np.int64)
+
+
+def detect_tiled(detector, image, tile, overlap=DEFAULT_OVERLAP, iou=DEFAULT_IOU):
+    """Run an InsightFace detector over the whole image plus tiles.
+
+    Returns ``(bboxes, kpss)`` in image coordinates like ``detector.detect``:
+    bboxes is N×5 (x1, y1, x2, y2, score), kpss N×5×2 or None.
+    """
+    height, width = image.shape[:2]
+    boxes, points = [], []
+
+    bboxes, kpss = detector.detect(image, max_num=0, metric="default")
+    boxes.append(bboxes)
+    points.append(kpss)
+
+    for y0, x0, y1, x1 in tile_grid(height, width, tile, overlap):
+        bboxes, kpss = detector.detect(image[y0:y1, x0:x1], max_num=0, metric="default")
+        if bboxes.shape[0] == 0:
+            continue
+        bboxes = bboxes.copy()
+        bboxes[:, [0, 2]] += x0
+        bboxes[:, [1, 3]] += y0
+        cut = (((x0 > 0) & (bboxes[:, 0] < x0 + EDGE_MARGIN)) |
+               ((y0 > 0) & (bboxes[:, 1] < y0 + EDGE_MARGIN)) |
+               ((x1 < width) & (bboxes[:, 2] > x1 - EDGE_MARGIN)) |
+               ((y1 < height) & (bboxes[:, 3] > y1 - EDGE_MARGIN)))
+        boxes.append(bboxes[~cut])
+        if kpss is not None:
+            kpss = kpss + np.array([x0, y0], dtype=kpss.dtype)
+            points.append(kpss[~cut])
+
+    bboxes = np.vstack(boxes)
+    kpss   = np.vstack(points) if all(k is not None for k in points) else None
+    if bboxes.shape[0] == 0:
+        return bboxes, kpss
+    keep = nms(bboxes[:, :4], bboxes[:, 4], iou)
+    return bboxes[keep], (kpss[keep] if kpss is not None else None)
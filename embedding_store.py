@@ -0,0 +1,293 @@
+# embedding_store.py — packed, memory-mapped embedding store
+#
+#   encodings/store.json          table: format, dim, data file, row counts and
+#                                 {student_id: {name, offset, count}}
+#   encodings/embeddings.<n>.f32  64-byte header + contiguous float32 rows
+#
+# Rows are L2-normalised on write so a Gallery can wrap the mapped matrix
+# without copying it. Saving a student appends a new block and tombstones the
+# old one; deleting only drops the table entry. Once dead rows outnumber live
+# ones the live blocks are copied to a fresh data file, and the table — which
+# names its data file — is the single commit point.
+#
+# Several worker processes may share one store: writers serialise on
+# encodings/.store.lock and every access re-reads the table once another
+# process has rewritten it. The table is written to a temporary file and
+# renamed over the old one, after the rows it names are flushed to disk, so a
+# crash leaves either the old or the new table, never a truncated one.
+import json
+import os
+import struct
+import threading
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:  # Windows: locks only cover threads of this process
+    FCNTL_AVAILABLE = False
+
+from gallery import EMBEDDING_DIM, l2_normalize
+
+STORE_FORMAT     = 1
+HEADER_BYTES     = 64
+MAGIC            = b"ATTNEMB\0"
+COMPACT_MIN_DEAD = 4096
+
+
+def _header(dim):
+    return struct.pack("<8sII", MAGIC, STORE_FORMAT, dim).ljust(HEADER_BYTES, b"\0")
+
+
+class FileLock:
+    """Re-entrant lock held across threads and, where flock exists, processes."""
+
+    def __init__(self, path):
+        self.path    = Path(path)
+        self._lock   = threading.RLock()
+        self._depth  = 0
+        self._handle = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0 and FCNTL_AVAILABLE:
+            # flock is per open file, so only the outermost holder takes it
+            self._handle = open(self.path, "a")
+            fcntl.flock(self._handle, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._handle is not None:
+            fcntl.flock(self._handle, fcntl.LOCK_UN)
+            self._handle.close()
+            self._handle = None
+        self._lock.release()
+
+
+class EmbeddingStore:
+    """Append-only float32 matrix plus an id → (offset, count) table."""
+
+    def __init__(self, directory, dim=EMBEDDING_DIM, legacy_index=None):
+        self.directory    = Path(directory)
+        self.table_file   = self.directory / "store.json"
+        self.dim          = dim
+        self.legacy_index = Path(legacy_index) if legacy_index else None
+        self._lock        = FileLock(self.directory / ".store.lock")
+        self._table       = None
+        self._matrix      = None
+        self._stamp       = None   # (mtime_ns, size) of the table as last read or written
+
+    # ── Reading ───────────────────────────────────────────────────────────────
+
+    def _ensure_open(self):
+        if self._table is None or self._stale():
+            with self._lock:
+                if self._table is None:
+                    self._open()
+                elif self._stale():
+                    self._read_table()
+
+    def _table_stamp(self):
+        try:
+            st = os.stat(self.table_file)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _stale(self):
+        """True once another process has committed a newer table."""
+        return self._table_stamp() != self._stamp
+
+    def _open(self):
+        if self.table_file.exists():
+            self._read_table()
+            return
+
+        self._table = self._new_table("embeddings.0.f32")
+        with open(self.directory / self._table["data_file"], "wb") as f:
+            f.write(_header(self.dim))
+        self._remap()
+        if self.legacy_index and self.legacy_index.exists():
+            self._import_legacy()
+        else:
+            self._write_table(self._table)
+
+    def _read_table(self):
+        stamp = self._table_stamp()
+        with open(self.table_file) as f:
+            table = json.load(f)
+        if table.get("format") != STORE_FORMAT or table.get("dim") != self.dim:
+            raise ValueError(f"Unsupported embedding store: format={table.get('format')} dim={table.get('dim')}")
+        with open(self.directory / table["data_file"], "rb") as f:
+            magic, version, dim = struct.unpack("<8sII", f.read(16))
+        if magic != MAGIC or version != STORE_FORMAT or dim != self.dim:
+            raise ValueError(f"Corrupt embedding store header in {table['data_file']}")
+        self._matrix = self._map(table)
+        self._table  = table
+        self._stamp  = stamp
+
+    def _new_table(self, data_file):
+        return {"format": STORE_FORMAT, "dim": self.dim, "data_file": data_file,
+                "rows": 0, "dead_rows": 0, "students": {}}
+
+    def _remap(self):
+        self._matrix = self._map(self._table)
+
+    def _map(self, table):
+        if table["rows"] == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self.directory / table["data_file"], dtype=np.float32,
+                         mode="r", offset=HEADER_BYTES, shape=(table["rows"], self.dim))
+
+    def _import_legacy(self):
+        """One-off migration from index.json + per-student .npy files."""
+        with open(self.legacy_index) as f:
+            index = json.load(f)
+        entries = []
+        for key, value in index.items():
+            name     = value["name"] if isinstance(value, dict) else key
+            filename = value["file"] if isinstance(value, dict) else value
+            path     = self.legacy_index.parent / filename
+            if path.exists():
+                entries.append((key, name, np.load(str(path))))
+        self.put_many(entries)
+        print(f"✅ Migrated {len(entries)} students from {self.legacy_index.name} to the embedding store")
+
+    def mapped(self, data_file, rows):
+        """Rows ``[0, rows)`` of a (possibly superseded) data file, e.g. from a shared snapshot."""
+        self._ensure_open()
+        matrix = self._matrix
+        if data_file == self._table["data_file"] and rows <= matrix.shape[0]:
+            return matrix[:rows]
+        return self._map({"data_file": data_file, "rows": rows})
+
+    @property
+    def matrix(self):
+        """All rows, live and dead, as a read-only memory map."""
+        self._ensure_open()
+        return self._matrix
+
+    @property
+    def data_file(self):
+        """Current data file name; changes only when the store is compacted."""
+        self._ensure_open()
+        return self._table["data_file"]
+
+    def students(self):
+        """``{student_id: {"name", "offset", "count"}}`` — treat as read-only."""
+        self._ensure_open()
+        return self._table["students"]
+
+    def get(self, student_id):
+        entry = self.students().get(str(student_id))
+        if entry is None:
+            return None
+        return self._matrix[entry["offset"]:entry["offset"] + entry["count"]]
+
+    @property
+    def live_rows(self):
+        return sum(e["count"] for e in self.students().values())
+
+    # ── Writing ───────────────────────────────────────────────────────────────
+
+    def put(self, student_id, name, embeddings):
+        self.put_many([(student_id, name, embeddings)])
+
+    def put_many(self, entries):
+        """Append one block per ``(student_id, name, embeddings)`` and commit once."""
+        with self._lock:
+            self._ensure_open()
+            table    = self._table
+            students = dict(table["students"])
+            offset   = table["rows"]
+            dead     = table["dead_rows"]
+            path     = self.directory / table["data_file"]
+            with open(path, "r+b") as f:
+                # Write at the committed end: rows left by an interrupted write are overwritten
+                f.seek(HEADER_BYTES + offset * self.dim * 4)
+                for student_id, name, embeddings in entries:
+                    rows = l2_normalize(embeddings)
+                    if rows.shape[1] != self.dim:
+                        raise ValueError(f"Expected {self.dim}-d embeddings, got {rows.shape[1]}")
+                    f.write(rows.tobytes())
+                    old = students.get(str(student_id))
+                    if old:
+                        dead += old["count"]
+                    students[str(student_id)] = {"name": name, "offset": offset, "count": rows.shape[0]}
+                    offset += rows.shape[0]
+                f.flush()
+                os.fsync(f.fileno())
+            self._commit(dict(table, rows=offset, dead_rows=dead, students=students))
+            self._maybe_compact()
+
+    def rename(self, student_id, name):
+        with self._lock:
+            self._ensure_open()
+            entry = self._table["students"].get(str(student_id))
+            if entry is None or entry["name"] == name:
+                return
+            students = dict(self._table["students"])
+            students[str(student_id)] = dict(entry, name=name)
+            self._commit(dict(self._table, students=students))
+
+    def delete(self, student_id):
+        with self._lock:
+            self._ensure_open()
+            students = dict(self._table["students"])
+            entry    = students.pop(str(student_id), None)
+            if entry is None:
+                return
+            self._commit(dict(self._table, students=students,
+                              dead_rows=self._table["dead_rows"] + entry["count"]))
+            self._maybe_compact()
+
+    def _commit(self, table):
+        self._write_table(table)
+        # Map first so a reader never sees table offsets beyond the mapped rows
+        matrix       = self._map(table)
+        self._matrix = matrix
+        self._table  = table
+
+    def _write_table(self, table):
+        tmp = self.table_file.with_name(self.table_file.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(table, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self.table_file)
+        self._stamp = self._table_stamp()
+
+    def _maybe_compact(self):
+        table = self._table
+        if table["dead_rows"] >= COMPACT_MIN_DEAD and table["dead_rows"] > table["rows"] - table["dead_rows"]:
+            self.compact()
+
+    def compact(self):
+        """Copy live blocks into a new data file and drop the tombstoned rows."""
+        with self._lock:
+            self._ensure_open()
+            table     = self._table
+            old_file  = table["data_file"]
+            generation = int(old_file.split(".")[1]) + 1
+            new_file  = f"embeddings.{generation}.f32"
+            students  = {}
+            offset    = 0
+            with open(self.directory / new_file, "wb") as f:
+                f.write(_header(self.dim))
+                for sid, entry in sorted(table["students"].items(), key=lambda kv: kv[1]["offset"]):
+                    rows = self._matrix[entry["offset"]:entry["offset"] + entry["count"]]
+                    f.write(np.ascontiguousarray(rows).tobytes())
+                    students[sid] = dict(entry, offset=offset)
+                    offset += entry["count"]
+                f.flush()
+                os.fsync(f.fileno())
+            self._commit(dict(table, data_file=new_file, rows=offset, dead_rows=0, students=students))
+            try:
+                # Open memmaps of older snapshots keep the unlinked file alive
+                (self.directory / old_file).unlink()
+            except OSError:
+                pass
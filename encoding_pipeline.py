@@ -0,0 +1,331 @@
+# encoding_pipeline.py — face enrolment fanned out over worker processes
+#
+# Encoding is decode → detect → embed for every image of every student and
+# is CPU-bound throughout, so one thread cannot use a many-core box. Each
+# worker process loads its own model replica (ONNX sessions cannot cross a
+# process boundary) with a single intra-op thread, so N workers keep N cores
+# busy, and is handed student folders in batches to keep the pickling
+# overhead per image small. Workers only return embeddings; the parent does
+# every store write, so the store keeps a single writer. Workers are spawned
+# without re-running the parent's main script (app.py), so they never import
+# the web app; they only need this module.
+#
+# encodings/manifest.json records, per image, its content hash and the row
+# its embedding occupies in the student's store block. A run only embeds new
+# or changed images, reuses the stored rows of the rest and drops the rows of
+# deleted ones; a different model (or decode size) invalidates everything.
+#
+# encodings/crops/<student_id>.npz keeps the aligned 112×112 crop, landmarks
+# and detection score of every enrolment face, keyed by the photo's hash.
+# When the manifest is invalidated — a new recognition model, say — photos
+# whose crop is cached skip decoding and detection and are embedded straight
+# from their crops, many at a time.
+import hashlib
+import json
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from importlib.machinery import ModuleSpec
+from pathlib import Path
+
+import numpy as np
+
+from face_embedding import CROP_SIZE, DEFAULT_BATCH, aligned_crop, embed_crops, get_faces
+from gallery import Gallery
+from imaging import load_image_rgb
+
+IMAGE_SUFFIXES  = {".jpg", ".jpeg", ".png"}
+MANIFEST_FORMAT = 1
+
+_analyzer = None   # the worker process's model replica
+
+
+def list_images(folder):
+    """Enrolment images in a student folder, by file name."""
+    return sorted(p for p in folder.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES)
+
+
+def folder_name(folder):
+    """Display name of a student folder (its name.txt, else the folder name)."""
+    name_file = folder / "name.txt"
+    return name_file.read_text(encoding="utf-8").strip() if name_file.exists() else folder.name
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def rows_digest(rows):
+    """Fingerprint of a student's stored block, to spot a manifest the store has moved past."""
+    return hashlib.sha1(np.ascontiguousarray(rows, dtype=np.float32).tobytes()).hexdigest()
+
+
+def pick_enrolment_face(faces, student_gallery):
+    """Return the detected face that best matches the student's embeddings so far."""
+    scored = [(i, face.normed_embedding) for i, face in enumerate(faces)
+              if getattr(face, "normed_embedding", None) is not None]
+    if not scored:
+        return faces[0]
+    matches = student_gallery.match(np.vstack([emb for _, emb in scored]), k=1)
+    best    = max(range(len(scored)), key=lambda j: matches[j][0]["score"] if matches[j] else -1.0)
+    return faces[scored[best][0]]
+
+
+def embed_images(analyzer, folder, filenames, max_side=0, known=None, digests=None, crops=None,
+                 batch_size=DEFAULT_BATCH):
+    """Embed the named images of a student folder.
+
+    Returns ``{filename: embedding or None}`` (None when the image fails to
+    decode or shows no face). `known` are embeddings of the student kept from
+    earlier runs; they help pick the right face in group shots. Given a
+    CropCache and every current image's ``{filename: sha1}`` `digests`,
+    images cached under the same hash are embedded from their crop and the
+    cache is brought up to date for the folder. Cached crops, and the faces
+    of each photo, go through the recognition model `batch_size` at a time.
+    """
+    student_id = folder.name
+    embeddings = [] if known is None else list(known)
+    result     = {}
+    cached     = crops.load(student_id, max_side) if crops is not None and digests is not None else {}
+    hits       = [f for f in filenames if f in cached and cached[f]["sha1"] == digests.get(f)]
+    fresh      = {}
+
+    with_crop = [f for f in hits if cached[f]["crop"] is not None]
+    if with_crop:
+        for filename, emb in zip(with_crop, embed_crops(analyzer.models["recognition"],
+                                                        [cached[f]["crop"] for f in with_crop], batch_size)):
+            result[filename] = emb
+            embeddings.append(emb)
+
+    for filename in filenames:
+        if filename in hits:
+            result.setdefault(filename, None)
+            continue
+        img_path         = folder / filename
+        result[filename] = None
+        try:
+            img_rgb = load_image_rgb(img_path, max_side)
+            faces   = get_faces(analyzer, img_rgb, batch_size)
+            sha1    = (digests or {}).get(filename)
+            if not faces:
+                fresh[filename] = {"sha1": sha1, "crop": None}
+                continue
+            face = faces[0]
+            if len(faces) > 1 and embeddings:
+                # Several people in the shot: keep the face closest to this student's others
+                face = pick_enrolment_face(faces, Gallery.from_students(
+                    [(student_id, student_id, np.vstack(embeddings))]))
+            if getattr(face, "kps", None) is not None:
+                fresh[filename] = {"sha1": sha1, "crop": aligned_crop(img_rgb, face.kps),
+                                   "kps": face.kps, "det_score": float(face.det_score)}
+            if getattr(face, "normed_embedding", None) is not None:
+                result[filename] = face.normed_embedding
+                embeddings.append(face.normed_embedding)
+        except Exception as e:
+            print(f"Encoding error ({img_path}): {e}")
+
+    if crops is not None and digests is not None:
+        current = {f: e for f, e in cached.items() if digests.get(f) == e["sha1"]}
+        current.update(fresh)
+        if fresh or len(current) != len(cached):
+            crops.save(student_id, current, max_side)
+    return result
+
+
+class CropCache:
+    """Aligned face crops per student, one ``<student_id>.npz`` each.
+
+    Entries are ``{filename: {"sha1", "crop", "kps", "det_score"}}``; a
+    photo without a usable face is kept with ``crop`` None so it is not
+    decoded again either. Crops cut at another decode size are ignored.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def _file(self, student_id):
+        return self.directory / f"{student_id}.npz"
+
+    def load(self, student_id, max_side):
+        path = self._file(student_id)
+        if not path.exists():
+            return {}
+        try:
+            with np.load(path) as data:
+                if int(data["max_side"]) != max_side:
+                    return {}
+                entries = {str(f): {"sha1": str(h), "crop": None}
+                           for f, h in zip(data["empty_files"], data["empty_sha1"])}
+                for i, (f, h) in enumerate(zip(data["files"], data["sha1"])):
+                    entries[str(f)] = {"sha1": str(h), "crop": data["crops"][i],
+                                       "kps": data["kps"][i], "det_score": float(data["det_scores"][i])}
+                return entries
+        except Exception as e:
+            print(f"Ignoring unreadable crop cache {path.name}: {e}")
+            return {}
+
+    def save(self, student_id, entries, max_side):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        faces = {f: e for f, e in entries.items() if e["crop"] is not None and e["sha1"]}
+        empty = {f: e for f, e in entries.items() if e["crop"] is None and e["sha1"]}
+        path  = self._file(student_id)
+        tmp   = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, max_side=max_side,
+                     files=np.array(list(faces), dtype=str),
+                     sha1=np.array([e["sha1"] for e in faces.values()], dtype=str),
+                     crops=(np.stack([e["crop"] for e in faces.values()]).astype(np.uint8) if faces
+                            else np.zeros((0, CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)),
+                     kps=(np.stack([e["kps"] for e in faces.values()]).astype(np.float32) if faces
+                          else np.zeros((0, 5, 2), dtype=np.float32)),
+                     det_scores=np.array([e["det_score"] for e in faces.values()], dtype=np.float32),
+                     empty_files=np.array(list(empty), dtype=str),
+                     empty_sha1=np.array([e["sha1"] for e in empty.values()], dtype=str))
+        tmp.replace(path)
+
+    def retain(self, student_ids):
+        """Delete the crops of students whose folders are gone."""
+        if not self.directory.exists():
+            return
+        for path in self.directory.glob("*.npz"):
+            if path.stem not in student_ids:
+                path.unlink()
+
+
+def init_worker(model, modules, det_size, threads=1):
+    """Process-pool initializer: load this worker's model replica once."""
+    global _analyzer
+    import onnxruntime
+    from insightface.app import FaceAnalysis
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    _analyzer = FaceAnalysis(name=model, providers=["CPUExecutionProvider"], sess_options=options,
+                             allowed_modules=modules)
+    _analyzer.prepare(ctx_id=-1, det_size=(det_size, det_size))
+
+
+def encode_batch(tasks, max_side=0, crops=None, batch_size=DEFAULT_BATCH):
+    """Worker task: `embed_images` for each ``(folder, filenames, known, digests)`` in the batch."""
+    return [(folder, embed_images(_analyzer, Path(folder), filenames, max_side, known, digests, crops, batch_size))
+            for folder, filenames, known, digests in tasks]
+
+
+def batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+@contextmanager
+def _main_script_hidden():
+    # spawn re-runs the parent's main script in each child as __mp_main__
+    # unless __main__ presents itself as a module named "__main__"
+    main  = sys.modules["__main__"]
+    saved = getattr(main, "__spec__", None)
+    main.__spec__ = ModuleSpec("__main__", None)
+    try:
+        yield
+    finally:
+        main.__spec__ = saved
+
+
+def encode_in_processes(tasks, processes, per_batch, worker_args, max_side=0, crops=None,
+                        batch_size=DEFAULT_BATCH):
+    """Yield ``(folder, {filename: embedding or None})`` per task, in completion order.
+
+    Tasks are ``(folder, filenames, known_embeddings, digests)``, sent
+    `per_batch` at a time to up to `processes` spawned workers, each set up
+    by `init_worker(*worker_args)`.
+    """
+    todo = batches([(str(folder), *rest) for folder, *rest in tasks], per_batch)
+    with ProcessPoolExecutor(max_workers=min(processes, len(todo)),
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=tuple(worker_args)) as pool:
+        with _main_script_hidden():   # workers start as tasks are submitted
+            futures = [pool.submit(encode_batch, batch, max_side, crops, batch_size) for batch in todo]
+        for future in as_completed(futures):
+            for folder, embedded in future.result():
+                yield Path(folder), embedded
+
+
+class EncodingManifest:
+    """Per-image content hash and store row of every encoded student image."""
+
+    def __init__(self, path, model):
+        self.path     = Path(path)
+        self.model    = model
+        self.students = {}
+        if self.path.exists():
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if data.get("format") == MANIFEST_FORMAT and data.get("model") == model:
+                    self.students = data["students"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable encoding manifest: {e}")
+
+    def plan(self, folder, stored):
+        """Work out what a student folder needs against its `stored` rows (or None).
+
+        Returns ``(images, keep, todo)``: ``images`` maps every current file
+        name to its ``{sha1, size, mtime_ns}``, ``keep`` maps unchanged file
+        names to their stored row (or None: no face) and ``todo`` lists the
+        file names to embed.
+        """
+        entry    = self.students.get(folder.name)
+        recorded = {}
+        if entry and stored is not None and entry.get("rows_sha1") == rows_digest(stored):
+            recorded = entry["images"]
+        elif entry and stored is None and entry.get("rows_sha1") is None:
+            recorded = entry["images"]   # only faceless images so far
+
+        images, keep, todo = {}, {}, []
+        for path in list_images(folder):
+            st  = path.stat()
+            old = recorded.get(path.name)
+            if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                sha1 = old["sha1"]
+            else:
+                sha1 = file_digest(path)
+            images[path.name] = {"sha1": sha1, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+            if old and old["sha1"] == sha1:
+                keep[path.name] = old["row"]
+            else:
+                todo.append(path.name)
+        return images, keep, todo
+
+    def unchanged(self, student_id, images, todo):
+        """True when the folder still holds exactly the recorded, unmodified images."""
+        entry = self.students.get(student_id)
+        return not todo and entry is not None and set(images) == set(entry["images"])
+
+    def refresh(self, student_id, images):
+        """Adopt the current size and mtime of unchanged images, so they are not hashed again."""
+        recorded = self.students[student_id]["images"]
+        for name, meta in images.items():
+            recorded[name] = dict(meta, row=recorded[name]["row"])
+
+    def record(self, student_id, images, rows, stored):
+        """Remember a student's images and the block now `stored` (or None) for them.
+
+        `rows` maps file names to their row in that block; images without a
+        face are left out and recorded with row None.
+        """
+        self.students[student_id] = {
+            "rows_sha1": rows_digest(stored) if stored is not None and len(stored) else None,
+            "images":    {name: dict(meta, row=rows.get(name)) for name, meta in images.items()},
+        }
+
+    def retain(self, student_ids):
+        """Forget students whose folders are gone."""
+        self.students = {sid: e for sid, e in self.students.items() if sid in student_ids}
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"format": MANIFEST_FORMAT, "model": self.model, "students": self.students}, f)
+        tmp.replace(self.path)
@@ -0,0 +1,380 @@
+# gallery.py — in-memory face gallery and batched matching engine
+import copy
+import threading
+
+import numpy as np
+
+EMBEDDING_DIM = 512
+
+# "templates": keep every enrolled image, score = best template per student
+# "centroid":  one averaged row per student, cost grows with students not images
+GALLERY_MODES = ("templates", "centroid")
+
+# First-pass scan representation; the shortlist is always re-scored in float32.
+# The int8 copy sits next to the float32 rows (needed for the re-score), so it
+# trades ¼ more memory for ¼ of the bytes read per scan.
+QUANTIZATION_MODES = ("none", "int8")
+DEFAULT_RESCORE    = 10
+SCAN_CHUNK_ROWS    = 8192
+SCAN_TILE_ROWS     = 512    # compact rows widened to float32 at a time (1 MB, stays in cache)
+
+_scan_tiles = threading.local()   # per-thread float32 scratch, reused across queries
+
+
+def _scan_scratch(dim, faces):
+    """This thread's (tile, product) buffers: SCAN_TILE_ROWS × dim and × faces."""
+    tile, product = getattr(_scan_tiles, "buffers", (None, None))
+    if tile is None or tile.shape[1] != dim:
+        tile = np.empty((SCAN_TILE_ROWS, dim), dtype=np.float32)
+    if product is None or product.shape[1] < faces:
+        product = np.empty((SCAN_TILE_ROWS, faces), dtype=np.float32)
+    _scan_tiles.buffers = tile, product
+    return tile, product[:, :faces]
+
+
+def l2_normalize(vectors):
+    """Return a float32 copy of `vectors` scaled to unit length row by row."""
+    arr = np.asarray(vectors, dtype=np.float32)
+    if arr.ndim == 1:
+        arr = arr.reshape(1, -1)
+    norms = np.linalg.norm(arr, axis=1, keepdims=True)
+    return arr / (norms + 1e-10)
+
+
+def quantize(rows, mode):
+    """Compact copy of normalised `rows` as ``(values, per_row_scale)``."""
+    rows = np.asarray(rows, dtype=np.float32)
+    if mode == "int8":
+        scale = np.abs(rows).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        return np.round(rows / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+    raise ValueError(f"Unknown quantization mode: {mode}")
+
+
+def _segments(offsets, counts, rows):
+    """``reduceat`` indices covering every block plus any gap after it.
+
+    Returns the indices and the positions within them that are student
+    blocks (the rest are gaps to be discarded). `offsets` must be sorted.
+    """
+    if offsets.size == 0:
+        return offsets, offsets
+    ends   = offsets + counts
+    starts = np.append(offsets[1:], rows)
+    gaps   = ends < starts
+    bounds = np.empty(offsets.size + int(gaps.sum()), dtype=np.int64)
+    pick   = np.arange(offsets.size) + np.concatenate(([0], np.cumsum(gaps)[:-1]))
+    bounds[pick] = offsets
+    bounds[pick[gaps] + 1] = ends[gaps]
+    if offsets[0] > 0:
+        # leading gap: fold it into a segment of its own at position 0
+        bounds = np.insert(bounds, 0, 0)
+        pick   = pick + 1
+    return bounds, pick
+
+
+class Gallery:
+    """An immutable snapshot of the enrolled embeddings, grouped by student.
+
+    Each student's templates occupy one contiguous block of the normalised
+    `source` matrix, so a student's scores can be reduced with a single
+    ``reduceat``. Blocks may be separated by unused rows (e.g. tombstones in a
+    memory-mapped store), which lets the gallery wrap a store's matrix without
+    copying it. Matching a photo is one (faces × dim) · (dim × rows) product
+    instead of one full-gallery normalisation per detected face.
+
+    Snapshots are never modified in place: `renamed`, `without` and
+    `upserted` return a new Gallery that shares the unchanged arrays, so
+    readers holding the old snapshot are never disturbed.
+
+    With `quantization` set, the first pass scans an int8 copy of the rows
+    (built lazily, in chunks that later snapshots reuse) and only the best
+    `rescore` students per face are scored again in float32. An attached
+    IVF index searches the float32 rows itself, so quantization is then
+    unused and the copy is never built.
+    """
+
+    def __init__(self, student_ids, names, counts, embeddings, mode="templates",
+                 offsets=None, normalized=False, quantization="none", rescore=DEFAULT_RESCORE):
+        if mode not in GALLERY_MODES:
+            raise ValueError(f"Unknown gallery mode: {mode}")
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode: {quantization}")
+        self.quantization = quantization
+        self.rescore      = rescore
+        counts = np.asarray(counts, dtype=np.int64)
+        if offsets is None:
+            offsets = np.concatenate(([0], np.cumsum(counts)[:-1])) if counts.size else counts
+        offsets = np.asarray(offsets, dtype=np.int64)
+        keep    = np.flatnonzero(counts > 0)
+        keep    = keep[np.argsort(offsets[keep], kind="stable")]
+
+        ids     = [str(student_ids[i]) for i in keep]
+        if ids:
+            source = np.asarray(embeddings, dtype=np.float32) if normalized else l2_normalize(embeddings)
+        else:
+            source = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        centroids = None
+        if mode == "centroid":
+            bounds, pick = _segments(offsets[keep], counts[keep], source.shape[0])
+            centroids    = (l2_normalize(np.add.reduceat(source, bounds, axis=0)[pick]) if ids
+                            else np.zeros((0, EMBEDDING_DIM), dtype=np.float32))
+        self._init(mode, ids, [names[i] for i in keep], counts[keep], offsets[keep], source, centroids)
+
+    def _init(self, mode, student_ids, names, src_counts, src_offsets, source, centroids=None):
+        self.mode        = mode
+        self.student_ids = student_ids
+        self.names       = names
+        self.source      = source
+        self.src_counts  = np.asarray(src_counts, dtype=np.int64)
+        self.src_offsets = np.asarray(src_offsets, dtype=np.int64)
+        self._position   = {sid: i for i, sid in enumerate(student_ids)}
+        self._searcher   = None
+        self.nprobe      = None
+        self._owners     = None
+        self._qchunks    = []
+
+        if mode == "centroid":
+            # one row per student, in list order
+            self.matrix  = centroids
+            self.offsets = np.arange(len(student_ids), dtype=np.int64)
+            self.counts  = np.ones(len(student_ids), dtype=np.int64)
+            self._reduce_at = self._reduce_pick = self.offsets
+        else:
+            self.matrix  = source
+            self.offsets = self.src_offsets
+            self.counts  = self.src_counts
+            self._reduce_at, self._reduce_pick = _segments(self.offsets, self.counts, source.shape[0])
+
+    def _derive(self, student_ids, names, src_counts, src_offsets, source, centroids=None):
+        """A new snapshot with this one's settings; `source` keeps existing rows in place."""
+        mode    = self.mode
+        gallery = type(self).__new__(type(self))
+        gallery.quantization = self.quantization
+        gallery.rescore      = self.rescore
+        if mode == "templates" and student_ids:
+            order       = np.argsort(src_offsets, kind="stable")
+            student_ids = [student_ids[i] for i in order]
+            names       = [names[i] for i in order]
+            src_counts  = np.asarray(src_counts)[order]
+            src_offsets = np.asarray(src_offsets)[order]
+        gallery._init(mode, student_ids, names, src_counts, src_offsets, source, centroids)
+        if mode == "templates":
+            # rows already quantised are unchanged; only appended rows need it
+            gallery._qchunks = self._qchunks
+        return gallery
+
+    @classmethod
+    def from_students(cls, entries, mode="templates", **kwargs):
+        """Build from an iterable of ``(student_id, name, embeddings)``."""
+        student_ids, names, counts, blocks = [], [], [], []
+        for student_id, name, embeddings in entries:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if embeddings.ndim == 1:
+                embeddings = embeddings.reshape(1, -1)
+            student_ids.append(student_id)
+            names.append(name)
+            counts.append(embeddings.shape[0])
+            blocks.append(embeddings)
+        stacked = np.vstack(blocks) if blocks else np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        return cls(student_ids, names, counts, stacked, mode=mode, **kwargs)
+
+    # ── Deltas ────────────────────────────────────────────────────────────────
+
+    def renamed(self, student_id, name):
+        pos = self._position.get(str(student_id))
+        if pos is None or self.names[pos] == name:
+            return self
+        gallery       = copy.copy(self)
+        gallery.names = list(self.names)
+        gallery.names[pos] = name
+        return gallery
+
+    def without(self, student_id):
+        pos = self._position.get(str(student_id))
+        if pos is None:
+            return self
+        keep = [i for i in range(self.student_count) if i != pos]
+        return self._derive([self.student_ids[i] for i in keep],
+                            [self.names[i] for i in keep],
+                            self.src_counts[keep], self.src_offsets[keep], self.source,
+                            np.delete(self.matrix, pos, axis=0) if self.mode == "centroid" else None)
+
+    def upserted(self, student_id, name, offset, count, source):
+        """Add or replace a student whose rows are ``source[offset:offset + count]``.
+
+        `source` must still hold every other student's block at its old
+        offset — true of an append-only store's remapped matrix.
+        """
+        base = self.without(student_id)
+        if count == 0:
+            return base
+        centroids = None
+        if self.mode == "centroid":
+            centroid  = l2_normalize(np.asarray(source[offset:offset + count]).sum(axis=0))
+            centroids = np.vstack([base.matrix, centroid])
+        return base._derive(base.student_ids + [str(student_id)],
+                            base.names + [name],
+                            np.append(base.src_counts, count),
+                            np.append(base.src_offsets, offset),
+                            source, centroids)
+
+    # ── Matching ──────────────────────────────────────────────────────────────
+
+    @property
+    def owners(self):
+        """Student position of every gallery row (-1 for unused rows)."""
+        if self._owners is None:
+            owners = np.full(self.size, -1, dtype=np.int64)
+            for pos, (start, count) in enumerate(zip(self.offsets, self.counts)):
+                owners[start:start + count] = pos
+            self._owners = owners
+        return self._owners
+
+    def _quantized(self):
+        """``[(start_row, values, scale)]`` covering every row, extended on demand."""
+        chunks  = self._qchunks
+        covered = chunks[-1][0] + chunks[-1][1].shape[0] if chunks else 0
+        if covered < self.size:
+            chunks = list(chunks)
+            for start in range(covered, self.size, SCAN_CHUNK_ROWS):
+                values, scale = quantize(self.matrix[start:start + SCAN_CHUNK_ROWS], self.quantization)
+                chunks.append((start, values, scale))
+            self._qchunks = chunks
+        return chunks
+
+    @property
+    def scan_bytes(self):
+        """Bytes read by a first-pass scan of the gallery."""
+        if self.quantization == "none":
+            return self.matrix.nbytes
+        return sum(v.nbytes + s.nbytes for _, v, s in self._quantized())
+
+    @property
+    def resident_bytes(self):
+        """Bytes held for matching: the float32 rows plus any compact copy."""
+        if self.quantization == "none":
+            return self.matrix.nbytes
+        return self.matrix.nbytes + self.scan_bytes
+
+    def attach_index(self, index, nprobe):
+        """Route matching through an approximate IVF index (see ann_index.py)."""
+        from ann_index import IVFSearcher
+        if self.student_count == 0:
+            return
+        if self.mode == "centroid":
+            row_cells = index.assign(self.matrix)
+        else:
+            # unused rows go to cell `nlist`, which is never probed
+            row_cells = np.full(self.size, index.nlist, dtype=np.int32)
+            for sid, start, count in zip(self.student_ids, self.offsets, self.counts):
+                row_cells[start:start + count] = index.assignments_for(sid, self.matrix[start:start + count])
+        self._searcher = IVFSearcher(index, row_cells, self.matrix, self.owners)
+        self.nprobe    = nprobe
+
+    @property
+    def indexed(self):
+        return self._searcher is not None
+
+    @property
+    def size(self):
+        """Number of rows scanned per query."""
+        return self.matrix.shape[0]
+
+    @property
+    def student_count(self):
+        return len(self.student_ids)
+
+    def name_of(self, student_id):
+        pos = self._position.get(str(student_id))
+        return self.names[pos] if pos is not None else None
+
+    def student_scores(self, queries):
+        """Cosine similarity of every query against every student (faces × students)."""
+        sims = l2_normalize(queries) @ self.matrix.T
+        if self.mode == "templates":
+            # max-over-templates: each student's rows are a contiguous slice
+            sims = np.maximum.reduceat(sims, self._reduce_at, axis=1)[:, self._reduce_pick]
+        return sims
+
+    def match(self, queries, k=1):
+        """Return, per query, up to `k` candidate students sorted best first.
+
+        Each candidate is a dict with ``student_id``, ``name`` and ``score``.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries.reshape(1, -1)
+        if self.student_count == 0 or queries.shape[0] == 0:
+            return [[] for _ in range(queries.shape[0])]
+
+        k = max(1, min(k, self.student_count))
+        if self._searcher is not None:
+            # the index scans the float32 rows of its probed cells; quantization does not apply
+            hits = self._searcher.search(l2_normalize(queries), k, self.nprobe)
+            return [[{"student_id": self.student_ids[pos], "name": self.names[pos], "score": float(score)}
+                     for pos, score in zip(positions, row_scores)]
+                    for positions, row_scores in hits]
+
+        if self.quantization != "none":
+            return self._match_quantized(queries, k)
+
+        sims = self.student_scores(queries)
+        if k < self.student_count:
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(self.student_count), (sims.shape[0], 1))
+        top_scores = np.take_along_axis(sims, top, axis=1)
+        order      = np.argsort(-top_scores, axis=1)
+        top        = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        return [[{"student_id": self.student_ids[pos], "name": self.names[pos], "score": float(score)}
+                 for pos, score in zip(positions, row_scores)]
+                for positions, row_scores in zip(top, top_scores)]
+
+    def _scan_quantized(self, queries):
+        """Approximate faces × rows scores read from the compact copy.
+
+        Only the compact values stream from memory: each SCAN_TILE_ROWS slice
+        is widened into a reused float32 tile that stays in cache, multiplied
+        there, and the per-row scales are applied to the product.
+        """
+        scores        = np.empty((queries.shape[0], self.size), dtype=np.float32)
+        tile, product = _scan_scratch(queries.shape[1], queries.shape[0])
+        for start, values, scale in self._quantized():
+            for at in range(0, values.shape[0], SCAN_TILE_ROWS):
+                n = min(SCAN_TILE_ROWS, values.shape[0] - at)
+                np.copyto(tile[:n], values[at:at + n])
+                np.matmul(tile[:n], queries.T, out=product[:n])
+                product[:n] *= scale[at:at + n, None]
+                scores[:, start + at:start + at + n] = product[:n].T
+        return scores
+
+    def _match_quantized(self, queries, k):
+        queries   = l2_normalize(queries)
+        shortlist = min(max(k, self.rescore), self.student_count)
+
+        # first pass: best template per student from the compact scan
+        approx = np.maximum.reduceat(self._scan_quantized(queries), self._reduce_at, axis=1)[:, self._reduce_pick]
+        if shortlist < self.student_count:
+            picked = np.argpartition(-approx, shortlist - 1, axis=1)[:, :shortlist]
+        else:
+            picked = np.tile(np.arange(self.student_count), (queries.shape[0], 1))
+
+        # exact float32 re-score: each query against its own shortlist's templates only
+        counts = self.counts[picked].ravel()
+        firsts = np.cumsum(counts) - counts   # each (query, student) pair's first row in `rows`
+        rows   = np.repeat(self.offsets[picked].ravel() - firsts, counts) + np.arange(counts.sum())
+        owner  = np.repeat(np.arange(queries.shape[0]), shortlist)
+        dots   = np.einsum("ij,ij->i", self.matrix[rows], queries[np.repeat(owner, counts)])
+        exact  = np.maximum.reduceat(dots, firsts).reshape(picked.shape)
+        order  = np.argsort(-exact, axis=1)[:, :k]
+        top    = np.take_along_axis(picked, order, axis=1)
+        scores = np.take_along_axis(exact, order, axis=1)
+        return [[{"student_id": self.student_ids[pos], "name": self.names[pos], "score": float(score)}
+                 for pos, score in zip(positions, row_scores)]
+                for positions, row_scores in zip(top, scores)]
+
+
+EMPTY_GALLERY = Gallery([], [], [], np.zeros((0, EMBEDDING_DIM), dtype=np.float32))
@@ -0,0 +1,26 @@
+# imaging.py — photo decoding shared by recognition and the encoding workers
+import numpy as np
+from PIL import Image, ImageOps
+
+
+def load_image_rgb(image_path, max_side=0, full_from=0):
+    """Decode a photo once, upright (EXIF) and as an RGB array.
+
+    With `max_side`, JPEGs are decoded straight at a reduced DCT scale and
+    other formats are box-reduced by an integer factor, so the full-size
+    bitmap is never allocated; the result is at least `max_side` on its
+    longest side. Photos whose header size reaches `full_from` on their
+    longest side are still decoded at full resolution.
+    """
+    with Image.open(image_path if hasattr(image_path, "read") else str(image_path)) as img:
+        if max_side and max(img.size) > max_side and not (full_from and max(img.size) >= full_from):
+            ratio = max_side / max(img.size)
+            if img.format == "JPEG":
+                img.draft("RGB", (int(np.ceil(img.width * ratio)), int(np.ceil(img.height * ratio))))
+            factor = max(img.size) // max_side
+            if factor > 1:
+                img = img.reduce(factor)
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return np.asarray(img)
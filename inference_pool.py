@@ -0,0 +1,93 @@
+# inference_pool.py — bounded pool of face-model replicas
+#
+# Each worker thread owns one model replica (its ONNX sessions sized with a
+# fixed number of intra-op threads), so N concurrent photos use N × threads
+# cores instead of every request thread fighting over one session. Callers
+# beyond the workers wait in a bounded queue; once that is full they are
+# turned away immediately with PoolBusy rather than piling up.
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PoolBusy(Exception):
+    """Raised when every worker is busy and the queue is full."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Recognition is busy; retry in {retry_after} s")
+        self.retry_after = retry_after
+
+
+class InferencePool:
+    """Run ``fn(replica, *args)`` on a free replica, at most `max_queue` callers waiting."""
+
+    def __init__(self, replicas, max_queue):
+        self.workers   = len(replicas)
+        self.max_queue = max_queue
+        self._free     = queue.SimpleQueue()
+        for replica in replicas:
+            self._free.put(replica)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self._slots    = threading.BoundedSemaphore(self.workers + max_queue)
+        self._lock     = threading.Lock()
+        self._queued    = 0
+        self._running   = 0
+        self._completed = 0
+        self._rejected  = 0
+        self._wait_sum  = 0.0
+        self._wait_max  = 0.0
+        self._run_sum   = 0.0
+
+    def run(self, fn, *args):
+        """Block until `fn` has run on a replica; raise PoolBusy if the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise PoolBusy(self.retry_after())
+        try:
+            with self._lock:
+                self._queued += 1
+            return self._executor.submit(self._call, time.perf_counter(), fn, args).result()
+        finally:
+            self._slots.release()
+
+    def _call(self, enqueued, fn, args):
+        replica = self._free.get()
+        started = time.perf_counter()
+        with self._lock:
+            self._queued  -= 1
+            self._running += 1
+            self._wait_sum += started - enqueued
+            self._wait_max  = max(self._wait_max, started - enqueued)
+        try:
+            return fn(replica, *args)
+        finally:
+            self._free.put(replica)
+            with self._lock:
+                self._running   -= 1
+                self._completed += 1
+                self._run_sum   += time.perf_counter() - started
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained, at least 1."""
+        with self._lock:
+            per_call = self._run_sum / self._completed if self._completed else 1.0
+            backlog  = self._queued + self._running
+        return max(1, math.ceil(per_call * backlog / self.workers))
+
+    def stats(self):
+        with self._lock:
+            done = self._completed
+            return {
+                "workers":     self.workers,
+                "max_queue":   self.max_queue,
+                "queued":      self._queued,
+                "running":     self._running,
+                "completed":   done,
+                "rejected":    self._rejected,
+                "avg_wait_ms": round(self._wait_sum / done * 1000, 1) if done else 0.0,
+                "max_wait_ms": round(self._wait_max * 1000, 1),
+                "avg_run_ms":  round(self._run_sum / done * 1000, 1) if done else 0.0,
+            }
@@ -0,0 +1,135 @@
+# shared_gallery.py — gallery snapshots shared between WSGI worker processes
+#
+# A tiny control segment holds a generation counter. Every publish writes the
+# snapshot's table (student ids, names, row offsets/counts and the store data
+# file they point into) to a new segment named after the generation, then
+# bumps the counter. Workers compare the counter on each lookup — a single
+# 8-byte read — and adopt the newer snapshot when it moved. The embedding rows
+# themselves are not copied: every worker maps the same store data file
+# read-only, so the OS shares those pages between processes.
+import json
+import struct
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from embedding_store import FileLock
+
+MAGIC         = b"ATTNGAL\1"              # last byte is the layout version
+CONTROL_BYTES = 8
+_HEADER       = struct.Struct("<8sQQQ64s")  # magic, students, rows, label bytes, data file
+
+
+# Python 3.13 added track=False; before that every process that opens a segment
+# registers it with its resource tracker, which unlinks it when that process
+# exits and pulls it from under the other workers.
+_UNTRACKED = sys.version_info >= (3, 13)
+
+
+def _open_segment(name, create=False, size=0):
+    if _UNTRACKED:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _unlink_segment(shm):
+    if not _UNTRACKED:
+        resource_tracker.register(shm._name, "shared_memory")  # unlink() unregisters it again
+    shm.unlink()
+
+
+def encode_snapshot(student_ids, names, offsets, counts, data_file, rows):
+    labels = json.dumps([student_ids, names]).encode("utf-8")
+    return b"".join([
+        _HEADER.pack(MAGIC, len(student_ids), rows, len(labels), data_file.encode("utf-8")),
+        np.asarray(offsets, dtype=np.int64).tobytes(),
+        np.asarray(counts, dtype=np.int64).tobytes(),
+        labels,
+    ])
+
+
+def decode_snapshot(buf):
+    # Segments may be larger than the payload (rounded up to a page on macOS
+    # and Windows), so the labels are read by their recorded length.
+    magic, students, rows, label_bytes, data_file = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a gallery snapshot segment")
+    pos     = _HEADER.size
+    offsets = np.frombuffer(buf, dtype=np.int64, count=students, offset=pos).copy()
+    counts  = np.frombuffer(buf, dtype=np.int64, count=students, offset=pos + 8 * students).copy()
+    labels  = pos + 16 * students
+    student_ids, names = json.loads(bytes(buf[labels:labels + label_bytes]).decode("utf-8"))
+    return {
+        "student_ids": student_ids,
+        "names":       names,
+        "offsets":     offsets,
+        "counts":      counts,
+        "data_file":   data_file.rstrip(b"\0").decode("utf-8"),
+        "rows":        rows,
+    }
+
+
+class SharedGalleryChannel:
+    """Generation counter plus the latest published snapshot table."""
+
+    def __init__(self, name, lock_file):
+        self.name     = name
+        self._lock    = FileLock(lock_file)
+        self._control = None
+
+    def _segment_name(self, generation):
+        return f"{self.name}_g{generation}"
+
+    def _ctl(self):
+        if self._control is None:
+            with self._lock:
+                try:
+                    self._control = _open_segment(f"{self.name}_ctl")
+                except FileNotFoundError:
+                    self._control = _open_segment(f"{self.name}_ctl", create=True, size=CONTROL_BYTES)
+                    self._control.buf[:CONTROL_BYTES] = bytes(CONTROL_BYTES)
+        return self._control
+
+    def lock(self):
+        """Hold while deriving and publishing a snapshot so no update is lost."""
+        return self._lock
+
+    def generation(self):
+        return struct.unpack_from("<Q", self._ctl().buf, 0)[0]
+
+    def read(self):
+        """Latest ``(generation, snapshot)``, or None if nothing was published yet."""
+        for _ in range(3):
+            generation = self.generation()
+            if generation == 0:
+                return None
+            try:
+                shm = _open_segment(self._segment_name(generation))
+            except FileNotFoundError:
+                continue  # superseded while we looked; read the counter again
+            try:
+                return generation, decode_snapshot(shm.buf)
+            except ValueError:
+                return None   # left by an older layout; the caller publishes a fresh one
+            finally:
+                shm.close()
+        return None
+
+    def publish(self, payload):
+        """Write a new generation and return its number. Call under `lock()`."""
+        generation = self.generation() + 1
+        shm = _open_segment(self._segment_name(generation), create=True, size=len(payload))
+        shm.buf[:len(payload)] = payload
+        shm.close()
+        struct.pack_into("<Q", self._ctl().buf, 0, generation)
+        try:
+            # Workers that already copied the old table are unaffected
+            old = _open_segment(self._segment_name(generation - 1))
+            _unlink_segment(old)
+            old.close()
+        except FileNotFoundError:
+            pass
+        return generation
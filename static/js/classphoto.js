@@ -80,16 +80,14 @@ document.addEventListener('DOMContentLoaded', function() {
             if (teacher) formData.append('teacher_id', teacher);
 
             showLoading('Uploading and recognizing faces...');
-            const response = await fetch('/recognize', { method: 'POST', body: formData });
+            const data = await runRecognitionJob(formData);
             hideLoading();
 
-            const data = await response.json();
-
             if (data.success) {
                 setStatus(`✅ Recognized ${data.recognized} of ${data.faces_found} faces`, 'text-emerald-400');
                 toast(`Attendance marked for ${data.recognized} students`, 'success');
 
-                if (data.annotated_image) {
+                if (data.annotated_url) {
                     const win = window.open('', '_blank');
                     if (win) {
                         win.document.write(`
@@ -99,7 +97,7 @@ document.addEventListener('DOMContentLoaded', function() {
                             .info{margin-top:20px;padding:20px;background:#1e293b;border-radius:10px;}</style>
                             </head><body>
                             <h2>Recognition Results</h2>
-                            <img src="${data.annotated_image}">
+                            <img src="${data.annotated_url}">
                             <div class="info">
                                 <p><strong>Faces found:</strong> ${data.faces_found}</p>
                                 <p><strong>Recognized:</strong> ${data.recognized}</p>
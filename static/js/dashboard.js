@@ -80,13 +80,12 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (teacher) formData.append('teacher_id', teacher);
 
                 showLoading('Processing faces...');
-                const response = await fetch('/recognize', { method: 'POST', body: formData });
+                const data = await runRecognitionJob(formData);
                 hideLoading();
 
-                const data = await response.json();
                 if (data.success) {
                     toast(`Recognized ${data.recognized} of ${data.faces_found} students`, 'success');
-                    if (data.annotated_image) showAnnotatedResult(data);
+                    if (data.annotated_url) showAnnotatedResult(data);
                     setTimeout(() => window.location.reload(), 2000);
                 } else {
                     toast(data.error || 'Recognition failed', 'error');
@@ -270,7 +269,7 @@ async function fetchEncodeStatus() {
             .info{margin-top:20px;padding:20px;background:#1e293b;border-radius:10px;}</style>
             </head><body>
             <h2>Recognition Results</h2>
-            <img src="${data.annotated_image}" alt="Annotated">
+            <img src="${data.annotated_url}" alt="Annotated">
             <div class="info">
                 <p><strong>Faces found:</strong> ${data.faces_found}</p>
                 <p><strong>Recognized:</strong> ${data.recognized}</p>
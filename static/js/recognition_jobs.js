@@ -0,0 +1,30 @@
+// static/js/recognition_jobs.js - Recognition through the background jobs API
+(function(){
+    // Submit a photo as a recognition job, then poll the job until it finishes.
+    // A full job queue (503) is retried after the server's Retry-After, up to
+    // `retries` times. Resolves with the same payload /recognize returns.
+    window.runRecognitionJob = async function(formData, { interval = 1000, timeout = 300000, retries = 3 } = {}) {
+        let response, submitted;
+        for (let attempt = 0; ; attempt++) {
+            response  = await fetch('/api/recognition_jobs', { method: 'POST', body: formData });
+            submitted = await response.json();
+            if (response.status !== 503 || attempt >= retries) break;
+            const wait = Number(response.headers.get('Retry-After')) || submitted.retry_after || 1;
+            await new Promise(resolve => setTimeout(resolve, wait * 1000));
+        }
+        if (!response.ok || !submitted.success) {
+            return { success: false, error: submitted.error || 'Recognition failed', retry_after: submitted.retry_after };
+        }
+
+        const deadline = Date.now() + timeout;
+        while (Date.now() < deadline) {
+            await new Promise(resolve => setTimeout(resolve, interval));
+            const job = await (await fetch(submitted.status_url)).json();
+            if (!job.success) return { success: false, error: job.error || 'Recognition job lost' };
+            if (job.status === 'done' || job.status === 'failed') {
+                return job.result || { success: false, error: job.error || 'Recognition failed' };
+            }
+        }
+        return { success: false, error: 'Recognition is taking longer than expected — check the attendance page shortly' };
+    };
+})();
\ No newline at end of file
@@ -85,8 +85,8 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
     // ========== CAPTURE CLASS PHOTO & RECOGNIZE ==========
-    // FIX: Sends image directly to /recognize (single request) instead of upload then recognize.
-    // This avoids the bug where annotated files could be picked up as "latest photo".
+    // Submits the image with the recognition job (not upload-then-recognize), so annotated
+    // files can never be picked up as the "latest photo"; the job is polled until done.
     const captureClassBtn = document.getElementById('captureClassBtn');
     if (captureClassBtn) {
         captureClassBtn.addEventListener('click', async function() {
@@ -115,10 +115,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 formData.append('subject_id', subjectId);
                 if (teacherId) formData.append('teacher_id', teacherId);
 
-                const response = await fetch('/recognize', { method: 'POST', body: formData });
+                const data = await runRecognitionJob(formData);
                 hideLoading();
 
-                const data = await response.json();
                 if (data.success) {
                     toast(`Attendance marked for ${data.recognized} students`, 'success', 3000);
                     setTimeout(() => { window.location.href = '/attendance'; }, 1500);
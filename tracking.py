@@ -0,0 +1,128 @@
+# tracking.py — frame-to-frame face tracking for streaming recognition
+#
+# A classroom camera sees the same faces in frame after frame, so embedding
+# every face of every frame repeats the most expensive step for nothing.
+# Detections are matched to the previous frame's tracks by box overlap (IoU);
+# a track keeps the identity it was given and is only re-embedded when it is
+# new or its face is clearly better than when it was last embedded (larger,
+# sharper detection). Tracks not seen for a few frames are dropped.
+import itertools
+
+import numpy as np
+
+DEFAULT_IOU          = 0.3
+DEFAULT_MAX_MISSES   = 15    # frames a track may go unseen before it is dropped
+DEFAULT_REEMBED_GAIN = 1.1   # quality ratio over the last embedding that earns a new one
+FULL_QUALITY_SIDE    = 112   # px; faces at least this large are not penalised for size
+
+
+def iou_matrix(a, b):
+    """Pairwise IoU of N×4 and M×4 ``(x1, y1, x2, y2)`` boxes as an N×M array."""
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter  = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union  = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-6), 0.0)
+
+
+def face_quality(bbox, det_score):
+    """Detector confidence scaled down for faces smaller than the embedder's input."""
+    side = min(bbox[2] - bbox[0], bbox[3] - bbox[1])
+    return float(det_score) * min(1.0, max(0.0, float(side)) / FULL_QUALITY_SIDE)
+
+
+class Track:
+    __slots__ = ("track_id", "bbox", "kps", "det_score", "quality", "embedded_quality",
+                 "student_id", "name", "confidence", "hits", "misses")
+
+    def __init__(self, track_id, bbox, kps, det_score):
+        self.track_id         = track_id
+        self.embedded_quality = 0.0
+        self.student_id       = None
+        self.name             = "Unknown"
+        self.confidence       = 0.0
+        self.hits             = 0
+        self.misses           = 0
+        self.observe(bbox, kps, det_score)
+
+    def observe(self, bbox, kps, det_score):
+        self.bbox      = np.asarray(bbox, dtype=np.float32)
+        self.kps       = kps
+        self.det_score = float(det_score)
+        self.quality   = face_quality(self.bbox, det_score)
+        self.hits     += 1
+        self.misses    = 0
+
+    def needs_embedding(self, gain=DEFAULT_REEMBED_GAIN):
+        return bool(self.embedded_quality == 0.0 or self.quality >= self.embedded_quality * gain)
+
+    def assign(self, student_id, name, confidence):
+        """Record a match made from the current face; the best confident identity sticks."""
+        self.embedded_quality = self.quality
+        if student_id is not None and (self.student_id is None or confidence >= self.confidence):
+            self.student_id = student_id
+            self.name       = name
+            self.confidence = confidence
+
+    def to_dict(self):
+        return {
+            "track_id":   self.track_id,
+            "bbox":       self.bbox.astype(int).tolist(),
+            "student_id": self.student_id,
+            "name":       self.name,
+            "confidence": self.confidence,
+            "quality":    round(self.quality, 3),
+        }
+
+
+class IoUTracker:
+    """Greedy IoU association of per-frame detections to persistent tracks."""
+
+    def __init__(self, iou=DEFAULT_IOU, max_misses=DEFAULT_MAX_MISSES):
+        self.iou        = iou
+        self.max_misses = max_misses
+        self.tracks     = []
+        self.created    = 0   # tracks started so far, i.e. distinct faces seen
+        self._ids       = itertools.count(1)
+
+    def update(self, bboxes, kpss=None):
+        """Advance one frame; returns the tracks seen in it, in detection order.
+
+        `bboxes` is N×5 (x1, y1, x2, y2, score) as from ``detector.detect``.
+        """
+        bboxes  = np.asarray(bboxes, dtype=np.float32).reshape(-1, 5)
+        matched = [None] * len(bboxes)
+        used    = set()
+        if self.tracks and len(bboxes):
+            overlap = iou_matrix([t.bbox for t in self.tracks], bboxes[:, :4])
+            # Best pairs first; each track and detection is used at most once
+            for ti, di in zip(*np.unravel_index(np.argsort(-overlap, axis=None), overlap.shape)):
+                if overlap[ti, di] < self.iou:
+                    break
+                if matched[di] is None and ti not in used:
+                    matched[di] = self.tracks[ti]
+                    used.add(ti)
+
+        seen = set()
+        for di, track in enumerate(matched):
+            kps = kpss[di] if kpss is not None else None
+            if track is None:
+                track = Track(next(self._ids), bboxes[di, :4], kps, bboxes[di, 4])
+                self.tracks.append(track)
+                self.created += 1
+                matched[di] = track
+            else:
+                track.observe(bboxes[di, :4], kps, bboxes[di, 4])
+            seen.add(track.track_id)
+
+        for track in self.tracks:
+            if track.track_id not in seen:
+                track.misses += 1
+        self.tracks = [t for t in self.tracks if t.misses <= self.max_misses]
+        return matched